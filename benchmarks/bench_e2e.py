@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+Runs redactedbetter end to end against a local mock tracker.
+
+Generates the synthetic corpus (see corpus.py), serves it from a
+MockTracker, and runs redactedbetter over it once for each variant of
+command line options given, each time with fresh state, caches and
+output. For each run it reports the wall time, requests made (as seen
+by the tracker), time spent waiting on the rate limit, CPU time and
+utilization of redactedbetter and its transcoders, and bytes written.
+
+    python benchmarks/bench_e2e.py [-s 30] [-t 4] [-j 4] [VARIANT ...]
+
+e.g., to compare the default with the pipelined, decode-once run:
+
+    python benchmarks/bench_e2e.py '' '-P -D -H'
+
+flac, lame and sox must be installed, as for redactedbetter itself.
+'''
+import argparse
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks, '..'))
+
+import corpus
+from mocktracker import MockTracker
+
+redactedbetter = os.path.join(benchmarks, '..', 'redactedbetter')
+
+config_template = '''[redacted]
+username = benchmark
+password = benchmark
+data_dir = %(data_dir)s
+output_dir = %(output_dir)s
+torrent_dir = %(torrent_dir)s
+formats = flac, v0, 320
+media = %(media)s
+24bit_behaviour = 0
+piece_length = auto
+torrent_builder = builtin
+site_url = %(site_url)s
+rate_limit_file = %(rate_limit_file)s
+response_cache = %(response_cache)s
+probe_index = %(probe_index)s
+session_file = %(session_file)s
+library_index = %(library_index)s
+'''
+
+def tree_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def run(variant, releases, data_dir, threads, verbose=False):
+    '''
+    Runs redactedbetter once over the corpus, returning a dict of
+    measurements.
+    '''
+    workdir = tempfile.mkdtemp(prefix='redactedbetter-bench-')
+    tracker = MockTracker(releases).start()
+    before = set(os.listdir(data_dir))
+    try:
+        paths = dict((name, os.path.join(workdir, name)) for name in
+                     ('output_dir', 'torrent_dir', 'rate_limit_file', 'response_cache', 'probe_index', 'session_file', 'library_index',
+                      'state', 'config'))
+        for name in ('output_dir', 'torrent_dir'):
+            os.makedirs(paths[name])
+        with open(paths['config'], 'w') as f:
+            f.write(config_template % dict(paths, data_dir=data_dir, site_url=tracker.url,
+                                           media='cd, web'))
+
+        command = [sys.executable, redactedbetter, '--config', paths['config'], '--state', paths['state'],
+                   '--cache', os.path.join(workdir, 'no-legacy-cache'), '-j', str(threads)] + variant.split()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        wall = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if verbose or process.returncode != 0:
+            print output
+        if process.returncode != 0:
+            raise Exception('redactedbetter exited with %d' % process.returncode)
+
+        match = re.search(r'Made (\d+) requests, spent ([\d.]+)s waiting', output)
+        requests, by_page = tracker.stats()
+        return {
+            'wall': wall,
+            'cpu': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+            'requests': requests,
+            'by_page': by_page,
+            'limiter_wait': float(match.group(2)) if match else None,
+            'uploads': len(tracker.uploads),
+            'written': tree_size(paths['output_dir']) + tree_size(paths['torrent_dir']),
+            'bytes_in': tracker.bytes_in,
+            'bytes_out': tracker.bytes_out,
+        }
+    finally:
+        tracker.stop()
+        # Single-file releases get a directory of their own in data_dir.
+        for name in set(os.listdir(data_dir)) - before:
+            shutil.rmtree(os.path.join(data_dir, name))
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('variants', nargs='*', default=['', '-P -D -H'],
+                        help='redactedbetter options for each run (default: \'\' and \'-P -D -H\')')
+    parser.add_argument('-s', '--seconds', type=int, default=30, help='length of each track')
+    parser.add_argument('-t', '--tracks', type=int, default=4, help='tracks per release (or per disc)')
+    parser.add_argument('-j', '--threads', type=int, default=cpu_count(), help='redactedbetter\'s --threads')
+    parser.add_argument('--corpus', help='where to keep the corpus between runs; releases already there are reused (default: a temporary directory)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show redactedbetter\'s output and requests by page')
+    args = parser.parse_args()
+
+    data_dir = args.corpus or tempfile.mkdtemp(prefix='redactedbetter-corpus-')
+    try:
+        print 'Generating corpus in %s...' % data_dir
+        releases = corpus.standard_corpus(data_dir, args.seconds, args.tracks)
+        corpus_size = sum(tree_size(r['path']) if os.path.isdir(r['path']) else os.path.getsize(r['path']) for r in releases)
+        print '%d releases, %.1f MiB' % (len(releases), corpus_size / float(1 << 20))
+        print
+
+        print '%-16s %8s %8s %8s %8s %8s %8s %6s %9s %9s' % ('variant', 'uploads', 'wall s', 's/rel', 'requests',
+                                                            'req/upl', 'wait s', 'cpu s', 'cpu util', 'MiB/rel')
+        for variant in args.variants:
+            result = run(variant, releases, data_dir, args.threads, args.verbose)
+            uploads = result['uploads']
+            print '%-16s %8d %8.1f %8.1f %8d %8s %8s %6.1f %8.0f%% %9.1f' % (
+                variant or '(default)', uploads, result['wall'], result['wall'] / len(releases), result['requests'],
+                '%.1f' % (result['requests'] / float(uploads)) if uploads else '-',
+                '%.1f' % result['limiter_wait'] if result['limiter_wait'] is not None else '-',
+                result['cpu'], 100 * result['cpu'] / (result['wall'] * cpu_count()),
+                result['written'] / float(1 << 20) / len(releases))
+            if args.verbose:
+                for (page, action), count in sorted(result['by_page'].items()):
+                    print '    %-14s %-14s %5d' % (page, action or '', count)
+                print '    %d bytes sent, %d bytes received by the tracker' % (result['bytes_out'], result['bytes_in'])
+    finally:
+        if not args.corpus:
+            shutil.rmtree(data_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+Compares the order release files are queued on the transcode pool in:
+track order, as they used to be, against longest first (see
+transcode.dispatch_order()).
+
+Each release has uneven track lengths, where track order leaves
+workers idle:
+
+    closer   seven short tracks and a closing track eight times as long
+    mixed    long and short tracks interleaved, ending on a long one
+
+For each release and worker count it reports the wall time of each
+order, the speedup, and the best wall time possible, which is the
+longer of the longest file and the total divided among the workers
+(taking each file's time from the longest-first run).
+
+    python benchmarks/bench_schedule.py [-s 15] [-j 2,4] [-f V0]
+
+flac, lame and sox must be installed.
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks, '..'))
+
+import corpus
+import metrics
+import releaseprobe
+import transcode
+
+layouts = {
+    'closer': [1, 1, 1, 1, 1, 1, 1, 8],
+    'mixed': [4, 1, 1, 4, 1, 1, 1, 4],
+}
+
+def run(probe, output_format, workers, longest_first):
+    '''
+    Transcodes the release on a fresh pool of workers, returning the
+    wall time and the time each file took.
+    '''
+    output_dir = tempfile.mkdtemp(prefix='redactedbetter-bench-')
+    try:
+        with transcode.TranscodePool(workers) as pool:
+            start = time.time()
+            pending = transcode.start_transcode_release(probe.flac_dir, output_dir, output_format, pool, probe,
+                                                        longest_first=longest_first)
+            pending.get()
+            wall = time.time() - start
+        histograms = metrics.registry.drain()[1]
+        return wall, [state for (name, labels), state in histograms if name == 'transcode_file_seconds']
+    finally:
+        shutil.rmtree(output_dir)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--seconds', type=int, default=15, help='length of the shortest track')
+    parser.add_argument('-j', '--workers', default='2,4', help='comma separated worker counts')
+    parser.add_argument('-f', '--format', default='V0', help='output format')
+    parser.add_argument('--corpus', help='where to keep the releases between runs; ones already there are reused (default: a temporary directory)')
+    args = parser.parse_args()
+
+    data_dir = args.corpus or tempfile.mkdtemp(prefix='redactedbetter-corpus-')
+    try:
+        print 'Generating releases in %s...' % data_dir
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        print '%-8s %2s %9s %9s %8s %9s' % ('release', 'j', 'in order', 'longest', 'speedup', 'best')
+        for seed, (name, lengths) in enumerate(sorted(layouts.items())):
+            release = corpus.make_release(data_dir, name, lengths=[args.seconds * l for l in lengths], seed=seed)
+            probe = releaseprobe.ReleaseProbe(release['path'])
+            # os.walk() doesn't promise any order; queue them in track
+            # order, which is the worst case for these layouts.
+            probe.flac_files.sort()
+            for workers in [int(w) for w in args.workers.split(',')]:
+                in_order, _ = run(probe, args.format.upper(), workers, False)
+                longest, files = run(probe, args.format.upper(), workers, True)
+                elapsed = [state['max'] for state in files]
+                total = sum(state['sum'] for state in files)
+                best = max(max(elapsed), total / workers)
+                print '%-8s %2d %8.1fs %8.1fs %7.2fx %8.1fs' % (name, workers, in_order, longest, in_order / longest, best)
+                sys.stdout.flush()
+    finally:
+        if not args.corpus:
+            shutil.rmtree(data_dir)
+
+if __name__ == '__main__':
+    main()
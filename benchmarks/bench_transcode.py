@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+Measures the transcode engine on this machine.
+
+Runs a matrix of source types (16/44.1, 24/48, 24/96, 24/192; see
+corpus.source_matrix()), output formats, worker counts and pipeline
+variants, and reports for each:
+
+    wall      seconds for all the files, on a pool of -j workers
+    rtf       realtime factor per file (seconds of audio per second),
+              mean and slowest
+    agg       seconds of audio per second of wall time, for the pool
+    cpu       CPU seconds used by the workers and their encoders
+    cpu/min   CPU seconds per minute of audio
+    pipe      for the pipe variant, the extra CPU it uses compared to
+              the tempfile variant (only if both are run)
+    rss       peak RSS of the largest process, in MiB
+
+The variants are:
+
+    tempfile  decode to a temporary WAV, then encode it, with no pipe;
+              set TMPDIR to a tmpfs to leave the disk out of it
+    pipe      transcode.transcode(), as redactedbetter runs it:
+              flac -dcs (or sox, to resample) piped into the encoder
+    sox       the same, but always decoding with sox
+    fanout    transcode.transcode_multi(): every format from one
+              decode (one row for all the formats)
+
+    python benchmarks/bench_transcode.py [-s 30] [-j 1,2,4] [-f FLAC,V0,320]
+        [-v tempfile,pipe,sox,fanout] [--sources 16-44,24-96] [--corpus DIR]
+
+Each cell runs in a process of its own, so CPU time and peak RSS are
+for that cell alone. flac, lame and sox must be installed.
+'''
+import argparse
+import multiprocessing
+import os
+import pipes
+import resource
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks, '..'))
+
+import corpus
+import releaseprobe
+import transcode
+
+variants = ['tempfile', 'pipe', 'sox', 'fanout']
+
+def job_pipe((flac_file, output_dir, output_format, info)):
+    start = time.time()
+    transcode.transcode(flac_file, output_dir, output_format, info)
+    return time.time() - start
+
+def job_sox((flac_file, output_dir, output_format, info)):
+    start = time.time()
+    resample, rate = transcode.transcode_settings(flac_file, info)
+    transcode_file = transcode.transcode_filename(flac_file, output_dir, output_format)
+    commands = transcode.transcode_commands(output_format, resample, rate, flac_file, transcode_file)
+    if not resample:
+        commands[0] = 'sox %s -t wav -' % pipes.quote(flac_file)
+    results = transcode.run_pipeline(commands)
+    transcode.check_pipeline(flac_file, commands, results)
+    transcode.finish_transcode(flac_file, transcode_file, output_format)
+    return time.time() - start
+
+def job_tempfile((flac_file, output_dir, output_format, info)):
+    start = time.time()
+    resample, rate = transcode.transcode_settings(flac_file, info)
+    transcode_file = transcode.transcode_filename(flac_file, output_dir, output_format)
+    commands = transcode.transcode_commands(output_format, resample, rate, flac_file, transcode_file)
+    if len(commands) == 1:
+        # sox resamples straight to FLAC; there's no pipe to take out.
+        results = transcode.run_pipeline(commands)
+        transcode.check_pipeline(flac_file, commands, results)
+    else:
+        decoder, encoder = commands
+        # See transcode.run_pipeline() about SIGPIPE.
+        sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        try:
+            with tempfile.TemporaryFile(suffix='.wav') as wav:
+                if subprocess.call(shlex.split(decoder), stdout=wav) != 0:
+                    raise transcode.TranscodeException('%s failed' % decoder)
+                wav.seek(0)
+                if subprocess.call(shlex.split(encoder), stdin=wav) != 0:
+                    raise transcode.TranscodeException('%s failed' % encoder)
+        finally:
+            signal.signal(signal.SIGPIPE, sigpipe_handler)
+    transcode.finish_transcode(flac_file, transcode_file, output_format)
+    return time.time() - start
+
+def job_fanout((flac_file, outputs, info)):
+    start = time.time()
+    errors = transcode.transcode_multi(flac_file, outputs, info)
+    failed = [error for error in errors.values() if error]
+    if failed:
+        raise transcode.TranscodeException(failed[0])
+    return time.time() - start
+
+jobs = {
+    'pipe': job_pipe,
+    'sox': job_sox,
+    'tempfile': job_tempfile,
+    'fanout': job_fanout,
+}
+
+def run_cell(variant, probe, output_formats, workers, connection):
+    '''
+    Transcodes every file in the release on a pool of workers, and sends
+    back (wall, per-file seconds, cpu, maxrss) over connection. Run in
+    a process of its own, so its children's resource usage is only
+    this cell's.
+    '''
+    output_dir = tempfile.mkdtemp(prefix='redactedbetter-bench-')
+    try:
+        tasks = []
+        for flac_file in probe.flac_files:
+            file_dir = os.path.join(output_dir, os.path.relpath(os.path.dirname(flac_file), probe.flac_dir))
+            if variant == 'fanout':
+                outputs = [(os.path.join(file_dir, output_format), output_format) for output_format in output_formats]
+                tasks.append((flac_file, outputs, probe.info[flac_file]))
+            else:
+                tasks.append((flac_file, file_dir, output_formats[0], probe.info[flac_file]))
+        start = time.time()
+        pool = multiprocessing.Pool(workers)
+        try:
+            elapsed = pool.map(jobs[variant], tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        wall = time.time() - start
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        connection.send((wall, elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        shutil.rmtree(output_dir)
+
+def measure(variant, probe, output_formats, workers):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_cell, args=(variant, probe, output_formats, workers, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--seconds', type=int, default=30, help='length of each track')
+    parser.add_argument('-t', '--tracks', type=int, default=4, help='tracks per source')
+    parser.add_argument('-j', '--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('-f', '--formats', default='FLAC,V0,320', help='comma separated output formats')
+    parser.add_argument('-v', '--variants', default=','.join(variants), help='comma separated pipeline variants')
+    parser.add_argument('--sources', help='comma separated source types to run (default: all)')
+    parser.add_argument('--corpus', help='where to keep the sources between runs; ones already there are reused (default: a temporary directory)')
+    args = parser.parse_args()
+
+    worker_counts = [int(w) for w in args.workers.split(',')]
+    output_formats = [f.strip().upper() for f in args.formats.split(',')]
+    chosen = [v.strip() for v in args.variants.split(',')]
+    for variant in chosen:
+        if variant not in jobs:
+            parser.error('unknown variant %s' % variant)
+    # The pipe variant is compared with tempfile, so run that first.
+    chosen.sort(key=lambda variant: variant != 'tempfile')
+
+    data_dir = args.corpus or tempfile.mkdtemp(prefix='redactedbetter-corpus-')
+    try:
+        print 'Generating sources in %s...' % data_dir
+        releases = corpus.source_matrix(data_dir, args.seconds, args.tracks)
+        if args.sources:
+            wanted = set(args.sources.split(','))
+            releases = [release for release in releases if release['name'] in wanted]
+
+        print '%-7s %-12s %-8s %2s %7s %7s %7s %7s %8s %7s %6s %6s' % (
+            'source', 'format', 'variant', 'j', 'wall', 'rtf', 'slowest', 'agg', 'cpu', 'cpu/min', 'pipe', 'rss')
+        cpu_by_cell = {}
+        for release in releases:
+            probe = releaseprobe.ReleaseProbe(release['path'])
+            audio = sum(info.length for info in probe.info.values())
+            for variant in chosen:
+                formats = [output_formats] if variant == 'fanout' else [[f] for f in output_formats]
+                for cell_formats in formats:
+                    for workers in worker_counts:
+                        wall, elapsed, cpu, maxrss = measure(variant, probe, cell_formats, workers)
+                        format_name = '+'.join(cell_formats)
+                        cpu_by_cell[(release['name'], format_name, variant, workers)] = cpu
+                        rtfs = [probe.info[f].length / e for f, e in zip(probe.flac_files, elapsed) if e > 0]
+                        baseline = cpu_by_cell.get((release['name'], format_name, 'tempfile', workers))
+                        pipe = '%+.0f%%' % (100 * (cpu - baseline) / baseline) if variant == 'pipe' and baseline else ''
+                        print '%-7s %-12s %-8s %2d %7.1f %7.1f %7.1f %7.1f %8.1f %7.2f %6s %6.0f' % (
+                            release['name'], format_name, variant, workers, wall,
+                            sum(rtfs) / len(rtfs), min(rtfs), audio / wall, cpu, cpu / (audio / 60),
+                            pipe, maxrss / 1024.0)
+                        sys.stdout.flush()
+    finally:
+        if not args.corpus:
+            shutil.rmtree(data_dir)
+
+if __name__ == '__main__':
+    main()
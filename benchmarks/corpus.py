@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+'''
+Generates synthetic FLAC releases for the benchmarks.
+
+Each track is a second of tone and noise, repeated for the length of
+the track and rotated by a different amount for each track, so every
+file has its own audio MD5 but costs about as much to decode and
+encode as real music. The flac encoder must be on the PATH; tags are
+written with mutagen.
+
+The standard corpus is one release of each layout redactedbetter has
+to deal with:
+
+    16-44       16/44.1 stereo, one directory
+    24-96       24/96 stereo, which has to be resampled
+    multi-disc  16/44.1, split into CD1 and CD2 directories
+    single      16/44.1, a single FLAC not in a directory of its own
+
+    python benchmarks/corpus.py [-s SECONDS] [-t TRACKS] OUTPUT_DIR
+
+With --matrix, the releases used by bench_transcode.py are written
+instead: one each of 16/44.1, 24/48, 24/96 and 24/192.
+
+What each release was written with is kept in .corpus.json in the
+output directory, so a release which is already there is reused if it
+was written the same way, and written again if not.
+'''
+import argparse
+import array
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import mutagen.flac
+
+# Extras which are put in every release directory, like a log and a
+# scan.
+extras = {
+    'release.log': 'Exact Audio Copy V1.0 beta 3 from 29. August 2011\r\n' * 200,
+    'folder.jpg': '\xff\xd8\xff\xe0' + '\x00' * 200000,
+}
+
+def signal(sample_rate, bits, channels, seed=0):
+    '''
+    Returns one second of raw little-endian signed PCM: a tone with a
+    little noise on top.
+    '''
+    rng = random.Random(seed)
+    peak = (1 << (bits - 1)) - 1
+    samples = array.array('i')
+    for n in xrange(sample_rate):
+        tone = 0.4 * math.sin(2 * math.pi * 440 * n / sample_rate) + 0.2 * math.sin(2 * math.pi * 1234.5 * n / sample_rate)
+        for channel in range(channels):
+            samples.append(int(peak * (tone + rng.uniform(-0.05, 0.05))))
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    width = bits // 8
+    data = samples.tostring()
+    # Keep the low bytes of each 32-bit sample.
+    return ''.join(data[i:i + width] for i in xrange(0, len(data), 4))
+
+def write_flac(path, pcm, seconds, sample_rate, bits, channels, offset, tags):
+    frame = channels * bits // 8
+    offset = (offset * frame) % len(pcm)
+    second = pcm[offset:] + pcm[:offset]
+    command = ['flac', '--silent', '--force-raw-format', '--endian=little', '--sign=signed',
+               '--channels=%d' % channels, '--bps=%d' % bits, '--sample-rate=%d' % sample_rate,
+               '-o', path, '-']
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for i in xrange(seconds):
+        encoder.stdin.write(second)
+    encoder.stdin.close()
+    if encoder.wait() != 0:
+        raise Exception('flac failed to write %s' % path)
+    info = mutagen.flac.FLAC(path)
+    for tag, value in tags.items():
+        info[tag] = value
+    info.save()
+
+def make_release(root, name, sample_rate=44100, bits=16, tracks=4, seconds=30, discs=1, single_file=False, seed=0,
+                 lengths=None):
+    '''
+    Writes a release under root and returns a description of it for
+    the mock tracker: its name, sample_rate, bits, the path of its
+    directory (or of its file, if single_file), and its files. If
+    lengths is given, it's the length of each track, in place of
+    tracks and seconds.
+    '''
+    if lengths is None:
+        lengths = [seconds] * tracks
+    if single_file:
+        path = os.path.join(root, '%s.flac' % name)
+    else:
+        path = os.path.join(root, '%s [FLAC]' % name)
+    params = {'sample_rate': sample_rate, 'bits': bits, 'lengths': list(lengths), 'discs': discs,
+              'single_file': single_file, 'seed': seed}
+    manifest_path = os.path.join(root, '.corpus.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest.get(name) == params and os.path.exists(path):
+        return describe_release(name, sample_rate, bits, path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    write_release(path, lengths, sample_rate, bits, discs, single_file, seed, 'Benchmark %s' % name)
+    manifest[name] = params
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return describe_release(name, sample_rate, bits, path)
+
+def write_release(path, lengths, sample_rate, bits, discs, single_file, seed, album):
+    pcm = signal(sample_rate, bits, 2, seed)
+    rng = random.Random(seed)
+    if single_file:
+        write_flac(path, pcm, sum(lengths), sample_rate, bits, 2, rng.randrange(sample_rate),
+                   {'artist': 'Benchmark', 'album': album, 'title': album, 'tracknumber': '1'})
+        return
+
+    for disc in range(1, discs + 1):
+        disc_dir = os.path.join(path, 'CD%d' % disc) if discs > 1 else path
+        os.makedirs(disc_dir)
+        for track, length in enumerate(lengths, 1):
+            filename = os.path.join(disc_dir, '%02d - Track %d.flac' % (track, track))
+            write_flac(filename, pcm, length, sample_rate, bits, 2, rng.randrange(sample_rate),
+                       {'artist': 'Benchmark', 'album': album, 'title': 'Track %d' % track,
+                        'tracknumber': str(track), 'discnumber': str(disc)})
+    for filename, data in extras.items():
+        with open(os.path.join(path, filename), 'wb') as f:
+            f.write(data)
+
+def describe_release(name, sample_rate, bits, path):
+    if not os.path.isdir(path):
+        return {'name': name, 'sample_rate': sample_rate, 'bits': bits, 'path': path,
+                'files': [(os.path.basename(path), os.path.getsize(path))]}
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(full_path, path), os.path.getsize(full_path)))
+    return {'name': name, 'sample_rate': sample_rate, 'bits': bits, 'path': path, 'files': sorted(files)}
+
+def standard_corpus(root, seconds=30, tracks=4):
+    '''
+    Writes the standard corpus under root, returning the descriptions
+    of its releases.
+    '''
+    if not os.path.exists(root):
+        os.makedirs(root)
+    return [
+        make_release(root, '16-44', 44100, 16, tracks, seconds, seed=1),
+        make_release(root, '24-96', 96000, 24, tracks, seconds, seed=2),
+        make_release(root, 'multi-disc', 44100, 16, tracks, seconds, discs=2, seed=3),
+        make_release(root, 'single', 44100, 16, tracks, seconds, single_file=True, seed=4),
+    ]
+
+def source_matrix(root, seconds=30, tracks=2):
+    '''
+    Writes one release of each source type in the transcode benchmark
+    (16/44.1, 24/48, 24/96 and 24/192) under root, returning their
+    descriptions.
+    '''
+    if not os.path.exists(root):
+        os.makedirs(root)
+    return [make_release(root, '%d-%d' % (bits, sample_rate // 1000), sample_rate, bits, tracks, seconds, seed=seed)
+            for seed, (bits, sample_rate) in enumerate([(16, 44100), (24, 48000), (24, 96000), (24, 192000)])]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir')
+    parser.add_argument('-s', '--seconds', type=int, default=30, help='length of each track')
+    parser.add_argument('-t', '--tracks', type=int, default=4, help='tracks per release (or per disc)')
+    parser.add_argument('--matrix', action='store_true', help='write the transcode benchmark\'s sources instead')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output_dir):
+        shutil.rmtree(args.output_dir)
+    if args.matrix:
+        releases = source_matrix(args.output_dir, args.seconds, args.tracks)
+    else:
+        releases = standard_corpus(args.output_dir, args.seconds, args.tracks)
+    for release in releases:
+        print '%-12s %s' % (release['name'], release['path'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+'''
+A local stand-in for the parts of the site redactedbetter talks to.
+
+It serves login.php (which starts a session; everything else redirects
+there without one), ajax.php (index, torrentgroup and torrent),
+torrents.php (the snatched list and .torrent downloads) and upload.php
+(the form, and uploads, which are added to their group), for a set of
+releases described by corpus.make_release(). Every request is counted
+by page and action, along with the bytes sent and received, so the
+benchmarks can report what a run would have cost against the real
+site.
+
+    tracker = MockTracker(releases)
+    tracker.start()
+    ... point site_url at tracker.url ...
+    tracker.stop()
+'''
+import BaseHTTPServer
+import SocketServer
+import Cookie
+import cgi
+import json
+import threading
+import urlparse
+from collections import defaultdict
+
+upload_form = '''<html><body>
+<form class="search_form" action="torrents.php" method="get"><input type="text" name="searchstr" /></form>
+<form action="" enctype="multipart/form-data" method="post" id="upload_table">
+<input type="hidden" name="submit" value="true" />
+<input type="hidden" name="auth" value="%(authkey)s" />
+<input type="hidden" name="groupid" value="%(groupid)s" />
+<input type="hidden" name="type" value="0" />
+<input type="file" name="file_input" />
+<input type="checkbox" name="remaster" value="1" />
+<input type="text" name="remaster_year" value="" />
+<input type="text" name="remaster_title" value="" />
+<input type="text" name="remaster_record_label" value="" />
+<input type="text" name="remaster_catalogue_number" value="" />
+<select name="format"><option value="">---</option><option value="MP3">MP3</option><option value="FLAC">FLAC</option></select>
+<select name="bitrate"><option value="">---</option><option value="192">192</option><option value="V2 (VBR)">V2 (VBR)</option>
+<option value="V0 (VBR)">V0 (VBR)</option><option value="320">320</option><option value="Lossless">Lossless</option>
+<option value="24bit Lossless">24bit Lossless</option></select>
+<select name="media"><option value="CD">CD</option><option value="DVD">DVD</option><option value="Vinyl">Vinyl</option>
+<option value="Soundboard">Soundboard</option><option value="SACD">SACD</option><option value="DAT">DAT</option>
+<option value="Cassette">Cassette</option><option value="WEB">WEB</option><option value="Blu-ray">Blu-ray</option></select>
+<textarea name="release_desc"></textarea>
+<input type="submit" value="Upload torrent" />
+</form></body></html>'''
+
+class MockTracker(object):
+    def __init__(self, releases, page_size=50, userid=1, authkey='benchmarkauthkey', passkey='benchmarkpasskey'):
+        self.userid = userid
+        self.authkey = authkey
+        self.passkey = passkey
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.torrents = {}
+        # Snatched torrents, newest first.
+        self.snatched = []
+        self.requests = defaultdict(int)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.uploads = []
+        self.next_id = 1000
+        self.sessions = set()
+        self.logins = 0
+        for index, release in enumerate(releases):
+            groupid = index + 1
+            torrentid = 100 + index
+            single = len(release['files']) == 1 and release['files'][0][0].endswith('.flac')
+            self.groups[groupid] = {
+                'id': groupid,
+                'name': 'Benchmark %s' % release['name'],
+                'year': 2017,
+            }
+            self.torrents[torrentid] = {
+                'id': torrentid,
+                'groupId': groupid,
+                'media': 'CD' if release['bits'] == 16 else 'WEB',
+                'format': 'FLAC',
+                'encoding': '24bit Lossless' if release['bits'] == 24 else 'Lossless',
+                'remasterYear': 2017,
+                'remasterTitle': '',
+                'remasterRecordLabel': 'Benchmark',
+                'remasterCatalogueNumber': 'BENCH-%d' % groupid,
+                'filePath': '' if single else release['path'].rstrip('/').split('/')[-1],
+                'fileList': '|||'.join('%s{{{%d}}}' % (name, size) for name, size in release['files']),
+                'infoHash': '%040X' % torrentid,
+                'snatched': 10,
+            }
+            self.snatched.insert(0, torrentid)
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def start(self):
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.server.tracker = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_sessions(self):
+        '''
+        Forgets every session, as if they had all expired.
+        '''
+        with self.lock:
+            self.sessions.clear()
+
+    def login(self):
+        with self.lock:
+            self.logins += 1
+            session = 'benchmark%d' % self.logins
+            self.sessions.add(session)
+        return session
+
+    def count(self, page, action=None):
+        with self.lock:
+            self.requests[(page, action)] += 1
+
+    def stats(self):
+        '''
+        Returns (total requests, {(page, action): count}).
+        '''
+        with self.lock:
+            return sum(self.requests.values()), dict(self.requests)
+
+    def group_response(self, groupid):
+        group = self.groups[groupid]
+        torrents = [dict(t) for t in sorted(self.torrents.values(), key=lambda t: t['id']) if t['groupId'] == groupid]
+        return {'group': group, 'torrents': torrents}
+
+    def ajax(self, params):
+        action = params.get('action')
+        if action == 'index':
+            return {'authkey': self.authkey, 'passkey': self.passkey, 'id': self.userid, 'username': 'benchmark'}
+        if action == 'torrentgroup':
+            return self.group_response(int(params['id']))
+        if action == 'torrent':
+            if 'hash' in params:
+                matches = [t for t in self.torrents.values() if t['infoHash'] == params['hash'].upper()]
+                if not matches:
+                    return None
+                torrent = matches[0]
+            else:
+                torrent = self.torrents.get(int(params['id']))
+                if torrent is None:
+                    return None
+            return {'group': self.groups[torrent['groupId']], 'torrent': dict(torrent)}
+        return None
+
+    def snatched_page(self, page, media=None):
+        snatched = [torrentid for torrentid in self.snatched if media is None or self.torrents[torrentid]['media'] == media]
+        start = (page - 1) * self.page_size
+        ids = snatched[start:start + self.page_size]
+        rows = ''.join('<tr><td><a href="torrents.php?id=%d&amp;torrentid=%d">Release</a></td></tr>\n'
+                       % (self.torrents[torrentid]['groupId'], torrentid) for torrentid in ids)
+        more = '<a href="#">Next &gt;</a>' if start + self.page_size < len(snatched) else ''
+        return '<html><body><table>\n%s</table>%s</body></html>' % (rows, more)
+
+    def upload(self, fields, torrent_data):
+        with self.lock:
+            self.next_id += 1
+            torrentid = self.next_id
+        groupid = int(fields['groupid'])
+        source = [t for t in self.torrents.values() if t['groupId'] == groupid][0]
+        torrent = dict(source)
+        torrent.update({
+            'id': torrentid,
+            'format': fields['format'],
+            'encoding': fields['bitrate'],
+            'media': fields['media'],
+            'remasterYear': int(fields['remaster_year']),
+            'remasterTitle': fields['remaster_title'],
+            'remasterRecordLabel': fields['remaster_record_label'],
+            'remasterCatalogueNumber': fields['remaster_catalogue_number'],
+            'infoHash': '%040X' % torrentid,
+            'snatched': 0,
+        })
+        with self.lock:
+            self.torrents[torrentid] = torrent
+            self.uploads.append((groupid, fields['format'], fields['bitrate'], len(torrent_data)))
+        return groupid
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code, body='', content_type='text/html', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.tracker.lock:
+            self.server.tracker.bytes_out += len(body)
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        return url.path.lstrip('/'), dict(urlparse.parse_qsl(url.query))
+
+    def logged_in(self):
+        cookies = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        with self.server.tracker.lock:
+            return 'session' in cookies and cookies['session'].value in self.server.tracker.sessions
+
+    def to_login(self):
+        self.respond(302, '', headers=[('Location', 'login.php')])
+
+    def do_GET(self):
+        tracker = self.server.tracker
+        page, params = self.parse()
+        tracker.count(page, params.get('action') or params.get('type'))
+        if page == 'login.php':
+            self.respond(200, '<html><body>Log in</body></html>')
+        elif not self.logged_in():
+            self.to_login()
+        elif page == 'ajax.php':
+            response = tracker.ajax(params)
+            if response is None:
+                body = json.dumps({'status': 'failure', 'error': 'bad parameters'})
+            else:
+                body = json.dumps({'status': 'success', 'response': response})
+            self.respond(200, body, 'application/json')
+        elif page == 'torrents.php' and params.get('type') == 'snatched':
+            self.respond(200, tracker.snatched_page(int(params.get('page', 1)), params.get('media')))
+        elif page == 'torrents.php' and params.get('action') == 'download':
+            self.respond(200, 'd4:infod4:name5:benchee', 'application/x-bittorrent')
+        elif page == 'upload.php':
+            self.respond(200, upload_form % {'authkey': tracker.authkey, 'groupid': params.get('groupid', '')})
+        else:
+            self.respond(200, '<html><body>Benchmark</body></html>')
+
+    def do_POST(self):
+        tracker = self.server.tracker
+        page, params = self.parse()
+        length = int(self.headers.get('Content-Length', 0))
+        with tracker.lock:
+            tracker.bytes_in += length
+        if page == 'login.php':
+            tracker.count(page)
+            self.rfile.read(length)
+            self.respond(200, '<html><body>Logged in</body></html>', headers=[('Set-Cookie', 'session=%s; path=/' % tracker.login())])
+        elif not self.logged_in():
+            tracker.count(page, 'upload' if page == 'upload.php' else None)
+            self.rfile.read(length)
+            self.to_login()
+        elif page == 'upload.php':
+            tracker.count(page, 'upload')
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+            fields = dict((key, form.getfirst(key)) for key in form.keys() if key != 'file_input')
+            if fields.get('auth') != tracker.authkey or 'file_input' not in form:
+                self.respond(200, upload_form % {'authkey': tracker.authkey, 'groupid': fields.get('groupid', '')})
+                return
+            groupid = tracker.upload(fields, form['file_input'].value)
+            self.respond(302, '', headers=[('Location', 'torrents.php?id=%d' % groupid)])
+        else:
+            tracker.count(page)
+            self.rfile.read(length)
+            self.respond(200, '<html><body>Benchmark</body></html>')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Decides how many files to transcode at once, from how busy the machine
+is.
+
+A Controller keeps a limit between a minimum and a maximum, and every
+interval seconds moves it by one:
+
+    down  if the load average is over the number of CPUs, so other
+          processes (the torrent client) are waiting for CPU time;
+          if more than iowait_high of the CPU time was spent waiting
+          on I/O, so more pipelines would only queue on the disk; or
+          if transcodes of a format have slowed to under slowdown of
+          the best speed seen for it at the current limit
+    up    if the load average leaves at least a CPU free, and none of
+          the above hold
+
+The load average and iowait are for the whole machine, and include
+our own transcodes. iowait is read from /proc/stat, so is only taken
+into account on Linux.
+
+Speeds are kept apart for files which are resampled, which are much
+slower than the same format from a CD-quality FLAC. They're forgotten
+whenever the limit changes, since more files at once makes each one
+slower by itself.
+'''
+import os
+import threading
+import time
+from multiprocessing import cpu_count
+
+import metrics
+
+def cpu_times(path='/proc/stat'):
+    '''
+    Returns (iowait, total) CPU time since boot, in clock ticks, or
+    None if they can't be read.
+    '''
+    try:
+        with open(path) as f:
+            fields = f.readline().split()
+    except IOError:
+        return None
+    if len(fields) < 6 or fields[0] != 'cpu':
+        return None
+    # user nice system idle iowait irq softirq steal; guest time is
+    # already counted in user.
+    ticks = [int(field) for field in fields[1:9]]
+    return ticks[4], sum(ticks)
+
+class Controller(object):
+    def __init__(self, minimum, maximum, interval=10, cpus=None, iowait_high=0.25, slowdown=0.6):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.cpus = cpus or cpu_count()
+        self.iowait_high = iowait_high
+        self.slowdown = slowdown
+        self.limit = minimum
+        self._lock = threading.Lock()
+        self._last = time.time()
+        self._cpu_times = cpu_times()
+        # By format, at the current limit: (jobs seen, moving average
+        # of speed, best average)
+        self._speeds = {}
+
+    def record(self, key, cost, elapsed):
+        '''
+        Records a finished transcode of key (its format or formats, and
+        whether it was resampled; see transcode.TranscodePool) which cost
+        cost (see transcode.job_cost()) and took elapsed seconds.
+        '''
+        if not elapsed > 0:
+            return
+        speed = cost / elapsed
+        with self._lock:
+            count, average, best = self._speeds.get(key, (0, speed, speed))
+            average = 0.7 * average + 0.3 * speed
+            self._speeds[key] = (count + 1, average, max(best, average))
+
+    def iowait(self):
+        '''
+        Returns the fraction of CPU time spent waiting on I/O since the
+        last call, or None if it isn't known.
+        '''
+        now = cpu_times()
+        last, self._cpu_times = self._cpu_times, now
+        if now is None or last is None or now[1] <= last[1]:
+            return None
+        return (now[0] - last[0]) / float(now[1] - last[1])
+
+    def slowed(self):
+        '''
+        Returns the formats whose transcodes have slowed down.
+        '''
+        return [key for key, (count, average, best) in self._speeds.items()
+                if count >= 3 and average < self.slowdown * best]
+
+    def adjust(self):
+        '''
+        Reconsiders the limit, if it's been at least interval seconds
+        since the last time, and returns it.
+        '''
+        with self._lock:
+            now = time.time()
+            if now - self._last < self.interval:
+                return self.limit
+            self._last = now
+
+            load = os.getloadavg()[0]
+            iowait = self.iowait()
+            slowed = self.slowed()
+            limit = self.limit
+            if load > self.cpus:
+                reason = 'load %.1f' % load
+                limit -= 1
+            elif iowait is not None and iowait > self.iowait_high:
+                reason = 'iowait %.0f%%' % (100 * iowait)
+                limit -= 1
+            elif slowed:
+                reason = '%s slowed down' % ', '.join(sorted(slowed))
+                limit -= 1
+            elif load <= self.cpus - 1:
+                reason = 'load %.1f' % load
+                limit += 1
+            limit = max(self.minimum, min(self.maximum, limit))
+            if limit != self.limit:
+                metrics.inc('concurrency_changes_total', direction='up' if limit > self.limit else 'down')
+                print 'Transcoding up to %d files at once (%s)' % (limit, reason)
+                self.limit = limit
+                self._speeds = {}
+            return self.limit
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+Queue of torrents fetched by torrent-crawl.py.
+
+Each torrent moves through the states queued -> downloading -> done ->
+transcoded: torrent-crawl.py queues it and hands the .torrent to the
+client, the client's completion hook (torrent-done.py) marks it done,
+and torrent-parse.py transcodes it. The queue is a SQLite database
+indexed by infohash, and every state change is a single atomic UPDATE,
+so the scripts can safely run at the same time.
+
+The database also remembers the torrents torrent-crawl.py turned down,
+and how many snatches they had, so it needn't ask about them again
+until they've had time to change.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+TRANSCODED = 'transcoded'
+
+# The states each state can be reached from. A torrent may finish
+# before torrent-crawl.py gets round to marking it downloading.
+transitions = {
+    DOWNLOADING: (QUEUED,),
+    DONE: (QUEUED, DOWNLOADING),
+    TRANSCODED: (DONE,),
+}
+
+# States which count towards the backlog.
+active_states = (QUEUED, DOWNLOADING, DONE)
+
+default_path = os.path.expanduser('~/.redactedbetter/crawl.db')
+
+class CrawlQueue(object):
+    def __init__(self, path=default_path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY,
+                infohash TEXT NOT NULL UNIQUE,
+                permalink TEXT NOT NULL,
+                torrent TEXT,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS queue_state ON queue (state)')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS rejected (
+                id INTEGER PRIMARY KEY,
+                snatched INTEGER,
+                checked REAL NOT NULL)''')
+
+    def add(self, torrent, infohash, state=QUEUED):
+        '''
+        Queues a torrent from RedactedAPI.get_better(). Returns False if
+        it was already queued.
+        '''
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute('''INSERT OR IGNORE INTO queue (id, infohash, permalink, torrent, state, updated)
+                    VALUES (?, ?, ?, ?, ?, ?)''', (torrent['id'], infohash.upper(), torrent['permalink'],
+                                                   torrent.get('torrent'), state, self.clock()))
+                return cursor.rowcount == 1
+
+    def _transition(self, column, value, state):
+        sources = transitions[state]
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute('UPDATE queue SET state = ?, updated = ? WHERE %s = ? AND state IN (%s)'
+                                          % (column, ', '.join('?' * len(sources))),
+                                          [state, self.clock(), value] + list(sources))
+                return cursor.rowcount == 1
+
+    def set_state(self, torrent_id, state):
+        '''
+        Moves a torrent to state, if that's allowed from its current
+        state. Returns whether it was moved.
+        '''
+        return self._transition('id', torrent_id, state)
+
+    def set_state_by_hash(self, infohash, state):
+        return self._transition('infohash', infohash.upper(), state)
+
+    def count(self, states=active_states):
+        with self._lock:
+            (count,) = self._db.execute('SELECT COUNT(*) FROM queue WHERE state IN (%s)' % ', '.join('?' * len(states)),
+                                        states).fetchone()
+        return count
+
+    def remove(self, torrent_id):
+        '''
+        Drops a torrent which is still queued, e.g., because its .torrent
+        couldn't be fetched. Returns whether it was dropped.
+        '''
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute('DELETE FROM queue WHERE id = ? AND state = ?', (torrent_id, QUEUED))
+                return cursor.rowcount == 1
+
+    def reject(self, torrent_id, snatched):
+        '''
+        Remembers that a torrent was turned down with snatched snatches.
+        '''
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO rejected (id, snatched, checked) VALUES (?, ?, ?)',
+                                 (torrent_id, snatched, self.clock()))
+
+    def rejected(self, torrent_ids):
+        '''
+        Returns a dict of (snatched, checked) for those of torrent_ids
+        which have been turned down.
+        '''
+        found = {}
+        with self._lock:
+            for torrent_id in torrent_ids:
+                row = self._db.execute('SELECT snatched, checked FROM rejected WHERE id = ?', (torrent_id,)).fetchone()
+                if row is not None:
+                    found[torrent_id] = (row['snatched'], row['checked'])
+        return found
+
+    def __contains__(self, torrent_id):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM queue WHERE id = ?', (torrent_id,)).fetchone() is not None
+
+    def in_state(self, state):
+        '''
+        Returns every torrent in state, oldest first, as dicts.
+        '''
+        with self._lock:
+            return [dict(row) for row in self._db.execute('SELECT * FROM queue WHERE state = ? ORDER BY updated', (state,))]
+
+    def import_json(self, path):
+        '''
+        Imports the JSON list used by older versions. Torrents marked
+        done are imported as done, the rest as downloading (their
+        .torrent files were fetched when they were added). Returns the
+        number imported.
+        '''
+        count = 0
+        for torrent in json.load(open(path)):
+            state = DONE if torrent['done'] else DOWNLOADING
+            if self.add(torrent, torrent['hash'], state):
+                count += 1
+        return count
+
+    def close(self):
+        self._db.close()
+
+def open_queue(path, legacy_path=None):
+    '''
+    Opens the queue at path, importing the JSON list at legacy_path the
+    first time it's created.
+    '''
+    new = not os.path.exists(path)
+    queue = CrawlQueue(path)
+    if new and legacy_path and os.path.exists(legacy_path):
+        print 'Imported %d torrents from %s' % (queue.import_json(legacy_path), legacy_path)
+    return queue
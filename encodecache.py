@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+'''
+Persistent cache of encoded files, so audio which has been transcoded
+once isn't encoded again: when a release is retried after a failed
+upload, or the same audio was snatched in more than one edition.
+
+Entries are keyed by everything that decides what the encoder writes
+(see transcode.encode_cache_key()): the MD5 of the decoded audio from
+the FLAC's STREAMINFO, its stream parameters, and the commands which
+made the encode, with the versions of the programs they ran. They're
+stored untagged, since editions of the same audio are tagged
+differently. A hit is reflinked into the transcode where the
+filesystem can, or copied, but never hard linked, since the copy is
+tagged afterwards.
+
+The files and a SQLite index of them are kept in one directory, shared
+by the transcode processes, and the least recently used entries are
+evicted to keep the total under max_size bytes.
+
+    python encodecache.py [--max-size GIB] DIRECTORY
+
+shows what's in a cache, evicting entries if it's over max_size.
+'''
+import errno
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import linking
+
+def make_key(*parts):
+    return hashlib.sha1('\0'.join(unicode(part).encode('utf-8') for part in parts)).hexdigest()
+
+class EncodeCache(object):
+    def __init__(self, directory, max_size, clock=time.time):
+        self.directory = directory
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # Hard links would share the cached file with a transcode
+        # that's about to be tagged.
+        self.linker = linking.Linker(linking.REFLINK)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS encodes (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS encodes_accessed ON encodes (accessed)')
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, keys, dst):
+        '''
+        Puts the cached encode for the first of keys which has one at
+        dst. Returns False if none of them do.
+        '''
+        with self._lock:
+            for key in keys:
+                if self._db.execute('SELECT 1 FROM encodes WHERE key = ?', (key,)).fetchone() is not None:
+                    break
+            else:
+                self.misses += 1
+                return False
+        try:
+            self.linker.link(self.path(key), dst)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted by another process since we looked.
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            with self._db:
+                self._db.execute('UPDATE encodes SET accessed = ? WHERE key = ?', (self.clock(), key))
+            self.hits += 1
+        return True
+
+    def store(self, key, src):
+        '''
+        Adds a copy of the encode at src under key, evicting older
+        entries to make room. Returns whether it was stored; failing to
+        is never an error, as the encode itself is fine.
+        '''
+        size = os.path.getsize(src)
+        if size > self.max_size:
+            return False
+        path = self.path(key)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.linker.link(src, temporary)
+            os.rename(temporary, path)
+            now = self.clock()
+            with self._lock:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO encodes (key, size, created, accessed) VALUES (?, ?, ?, ?)',
+                                     (key, size, now, now))
+                    evicted = self._evict()
+        except (EnvironmentError, sqlite3.Error) as e:
+            print 'Couldn\'t add %s to the encode cache: %s' % (src, e)
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return False
+        self._remove(evicted)
+        return True
+
+    def evict(self):
+        '''
+        Evicts the least recently used entries until the cache is under
+        max_size. Returns the number evicted.
+        '''
+        with self._lock:
+            with self._db:
+                evicted = self._evict()
+        self._remove(evicted)
+        return len(evicted)
+
+    def _evict(self):
+        # Called in a write transaction, so other processes can't
+        # evict the same entries at the same time.
+        (total,) = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM encodes').fetchone()
+        evicted = []
+        if total <= self.max_size:
+            return evicted
+        for key, size in self._db.execute('SELECT key, size FROM encodes ORDER BY accessed').fetchall():
+            evicted.append(key)
+            total -= size
+            if total <= self.max_size:
+                break
+        self._db.executemany('DELETE FROM encodes WHERE key = ?', [(key,) for key in evicted])
+        return evicted
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def counts(self):
+        '''
+        Returns (entries, total size in bytes).
+        '''
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM encodes').fetchone()
+
+    def close(self):
+        self._db.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Show and trim an encode cache.')
+    parser.add_argument('--max-size', type=float, help='evict entries until the cache is under this many GiB')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+
+    directory = os.path.expanduser(args.directory)
+    max_size = int(args.max_size * (1 << 30)) if args.max_size is not None else float('inf')
+    cache = EncodeCache(directory, max_size)
+    evicted = cache.evict()
+    entries, size = cache.counts()
+    print '%d encodes, %.1f MB (%d evicted)' % (entries, size / 1048576.0, evicted)
+    cache.close()
+
+if __name__ == "__main__": main()
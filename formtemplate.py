@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Templates of the site's HTML forms, so they can be submitted without
+fetching and parsing the page each time.
+
+A FormTemplate is learned from a parsed mechanize form: the fields it
+would submit by default (hidden fields included), the values allowed
+by each select, radio and checkbox, and the name of its file control.
+Templates are plain dicts when stored, and are checked when they're
+loaded and again when they're filled in, so a stale template fails
+before anything is posted.
+
+A form's defaults may be prefilled from whatever the page was for (the
+group, for an upload form), so a template to be reused for other pages
+is learned with neutral=True: text fields are left empty, selects
+default to their first option and radios and checkboxes to unset.
+Hidden fields and submit buttons keep their values, as they're the
+form's own.
+'''
+
+class FormTemplateError(Exception):
+    pass
+
+class FormTemplate(object):
+    def __init__(self, pairs, options, file_control=None):
+        # (name, value) pairs submitted by default, in form order.
+        self.pairs = [tuple(pair) for pair in pairs]
+        # Allowed values for each select, radio and checkbox.
+        self.options = dict((name, list(values)) for name, values in options.items())
+        self.file_control = file_control
+
+    @classmethod
+    def from_form(cls, form, neutral=False):
+        file_controls = [control.name for control in form.controls if control.type == 'file']
+        options = {}
+        for control in form.controls:
+            if control.type in ('select', 'radio', 'checkbox') and control.name:
+                options.setdefault(control.name, []).extend(item.name for item in control.items)
+        types = dict((control.name, control.type) for control in form.controls if control.name)
+        pairs = []
+        for name, value in form.click_pairs():
+            if name in file_controls:
+                continue
+            if neutral:
+                if types.get(name) in ('radio', 'checkbox'):
+                    continue
+                elif types.get(name) == 'select':
+                    if name in [pair_name for pair_name, pair_value in pairs]:
+                        # Another of a multiple select's selections.
+                        continue
+                    value = options[name][0] if options[name] else ''
+                elif types.get(name) not in ('hidden', 'submit', 'image'):
+                    value = ''
+            pairs.append((name, value))
+        return cls(pairs, options, file_controls[0] if file_controls else None)
+
+    def to_dict(self):
+        return {'pairs': self.pairs, 'options': self.options, 'file_control': self.file_control}
+
+    @classmethod
+    def from_dict(cls, data, required=()):
+        '''
+        Loads a template stored with to_dict(). Raises FormTemplateError
+        if it's malformed or lacks any of the required fields.
+        '''
+        try:
+            template = cls(data['pairs'], data['options'], data.get('file_control'))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise FormTemplateError('Malformed form template')
+        template.require(required)
+        return template
+
+    def names(self):
+        return set(name for name, value in self.pairs) | set(self.options)
+
+    def require(self, names):
+        missing = set(names) - self.names()
+        if missing:
+            raise FormTemplateError('Form template has no field %s' % ', '.join(sorted(missing)))
+
+    def fill(self, values):
+        '''
+        Returns the (name, value) pairs to submit, with the given values
+        replacing the defaults. Raises FormTemplateError if a field
+        isn't in the form or a value isn't one of its options.
+        '''
+        self.require(values)
+        for name, value in values.items():
+            if name in self.options and value not in self.options[name]:
+                raise FormTemplateError('"%s" is not an option for %s' % (value, name))
+        pairs = []
+        filled = set()
+        for name, value in self.pairs:
+            if name in values:
+                if name in filled:
+                    continue
+                filled.add(name)
+                value = values[name]
+            pairs.append((name, value))
+        # Fields which aren't submitted by default, such as unchecked
+        # checkboxes.
+        pairs.extend((name, value) for name, value in sorted(values.items()) if name not in filled)
+        return pairs
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+'''
+The local socket `redactedbetter --daemon` takes jobs on.
+
+The protocol is a single JSON object per line, each way. A client
+sends one request and reads one response:
+
+    {"action": "submit", "urls": [PERMALINK, ...], "hashes": [INFOHASH, ...]}
+    {"status": "ok", "queued": 3}
+
+    {"action": "status"}
+    {"status": "ok", "queued": 1, "draining": false}
+
+and on any error, {"status": "error", "error": MESSAGE}. The socket is
+only accessible to its owner.
+
+    python jobsocket.py [--socket PATH] (URL | INFOHASH) ...
+
+submits jobs from the command line, or from a torrent client's
+completion hook.
+'''
+import SocketServer
+import argparse
+import errno
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import urlparse
+
+default_path = os.path.expanduser('~/.redactedbetter/daemon.sock')
+
+infohash_re = re.compile(r'^[0-9A-Fa-f]{40}$')
+
+class JobSocketError(Exception):
+    pass
+
+def parse_release_url(url):
+    '''
+    Returns the (groupid, torrentid) of a release's URL or permalink,
+    or raises ValueError.
+    '''
+    query = dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+    try:
+        return int(query['id']), int(query['torrentid'])
+    except (KeyError, ValueError):
+        raise ValueError('Not a release URL: %s' % url)
+
+def is_infohash(value):
+    return bool(infohash_re.match(value))
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Just checking we're here; see is_listening().
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+            response = self.server.handler(request)
+            response['status'] = 'ok'
+        except Exception as e:
+            response = {'status': 'error', 'error': str(e)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+class JobServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    Serves requests on a Unix socket at path, in a thread of its own.
+    handler is called with each request, and returns a dict to respond
+    with or raises an exception to report an error.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            if is_listening(path):
+                raise JobSocketError('Another daemon is already listening on %s' % path)
+            # Left behind by a daemon that didn't exit cleanly.
+            os.unlink(path)
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        finally:
+            os.umask(umask)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def is_listening(path):
+    '''
+    Returns whether anything is accepting connections on the socket at
+    path.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        sock.close()
+
+def send(request, path=default_path, timeout=30):
+    '''
+    Sends a request to the daemon at path, returning its response.
+    Raises socket.error if no daemon is listening, and JobSocketError
+    if the daemon reports an error.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        f = sock.makefile('rw')
+        f.write(json.dumps(request) + '\n')
+        f.flush()
+        line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise JobSocketError('The daemon closed the connection')
+    response = json.loads(line)
+    if response.get('status') != 'ok':
+        raise JobSocketError(response.get('error', 'Unknown error'))
+    return response
+
+def submit(urls=(), hashes=(), path=default_path):
+    '''
+    Queues releases on the daemon by URL and by infohash, returning the
+    number queued.
+    '''
+    return send({'action': 'submit', 'urls': list(urls), 'hashes': list(hashes)}, path)['queued']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('jobs', nargs='*', help='release URLs or infohashes to queue')
+    parser.add_argument('--socket', help='the daemon\'s socket', default=default_path)
+    args = parser.parse_args()
+
+    try:
+        if not args.jobs:
+            print json.dumps(send({'action': 'status'}, args.socket), sort_keys=True)
+            return
+        hashes = [job for job in args.jobs if is_infohash(job)]
+        urls = [job for job in args.jobs if not is_infohash(job)]
+        print 'Queued %d releases' % submit(urls, hashes, args.socket)
+    except (socket.error, JobSocketError) as e:
+        print 'Error: %s' % e
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+'''
+Index of what's in data_dir, so snatches whose files are gone can be
+passed over without asking the site about them.
+
+A LibraryIndex keeps the names in data_dir (release directories and
+single FLACs) and, for each torrent whose group has been fetched, the
+name its files are under. A snatched torrent whose name is known but
+no longer in data_dir is missing; one whose name isn't known yet has
+to be fetched once to find out. The names are read again whenever
+data_dir's modification time changes, which it does whenever anything
+is added to, renamed in or removed from it.
+'''
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+
+default_path = os.path.expanduser('~/.redactedbetter/library.db')
+
+def torrent_name(torrent):
+    '''
+    Returns the name of a torrent's files in data_dir: its directory,
+    or for a single-file torrent, the file, as the site lists it.
+    '''
+    if torrent['filePath']:
+        return torrent['filePath']
+    return torrent['fileList'].split('{{{')[0]
+
+def decode_name(name):
+    if isinstance(name, unicode):
+        return name
+    return name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+class LibraryIndex(object):
+    def __init__(self, path, data_dir, clock=time.time):
+        self.path = path
+        self.data_dir = data_dir
+        self.clock = clock
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                name TEXT PRIMARY KEY)''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS torrents (
+                torrentid INTEGER PRIMARY KEY,
+                groupid INTEGER,
+                name TEXT NOT NULL,
+                recorded REAL NOT NULL)''')
+            # The data_dir the entries were read from, and its mtime
+            # at the time.
+            self._db.execute('''CREATE TABLE IF NOT EXISTS scan (
+                data_dir TEXT PRIMARY KEY,
+                mtime REAL NOT NULL)''')
+        self._mtime = None
+        # Candidates passed over by filter_missing().
+        self.skipped = 0
+
+    def refresh(self):
+        '''
+        Reads data_dir's names again if it has changed since they were
+        last read. Returns (added, removed) names.
+        '''
+        mtime = os.stat(self.data_dir).st_mtime
+        with self._lock:
+            if mtime == self._mtime:
+                return 0, 0
+            row = self._db.execute('SELECT mtime FROM scan WHERE data_dir = ?', (decode_name(self.data_dir),)).fetchone()
+            if row is not None and row[0] == mtime:
+                self._mtime = mtime
+                return 0, 0
+            names = set(decode_name(name) for name in os.listdir(self.data_dir) if not name.startswith('.'))
+            if row is None:
+                # First scan, or of another data_dir.
+                known = set()
+            else:
+                known = set(name for (name,) in self._db.execute('SELECT name FROM entries'))
+            added, removed = names - known, known - names
+            with self._db:
+                if row is None:
+                    self._db.execute('DELETE FROM entries')
+                self._db.executemany('INSERT INTO entries (name) VALUES (?)', [(name,) for name in added])
+                self._db.executemany('DELETE FROM entries WHERE name = ?', [(name,) for name in removed])
+                self._db.execute('DELETE FROM scan')
+                self._db.execute('INSERT INTO scan (data_dir, mtime) VALUES (?, ?)', (decode_name(self.data_dir), mtime))
+            self._mtime = mtime
+        return len(added), len(removed)
+
+    def record(self, torrentid, groupid, name):
+        '''
+        Records which name a torrent's files are under.
+        '''
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO torrents (torrentid, groupid, name, recorded) VALUES (?, ?, ?, ?)',
+                                 (int(torrentid), groupid, decode_name(name), self.clock()))
+
+    def lookup(self, torrentid):
+        '''
+        Returns the name a torrent's files are under, or None if it isn't
+        known.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT name FROM torrents WHERE torrentid = ?', (int(torrentid),)).fetchone()
+        return row[0] if row else None
+
+    def missing(self, torrentid):
+        '''
+        Returns whether a torrent is known, and its files aren't in
+        data_dir.
+        '''
+        name = self.lookup(torrentid)
+        if name is None:
+            return False
+        self.refresh()
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries WHERE name = ?', (name,)).fetchone() is None
+
+    def counts(self):
+        '''
+        Returns (names in data_dir, torrents known, torrents known to be
+        missing).
+        '''
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            torrents = self._db.execute('SELECT COUNT(*) FROM torrents').fetchone()[0]
+            missing = self._db.execute('''SELECT COUNT(*) FROM torrents
+                WHERE name NOT IN (SELECT name FROM entries)''').fetchone()[0]
+        return entries, torrents, missing
+
+    def close(self):
+        self._db.close()
+
+def filter_missing(index, candidates, on_missing=None):
+    '''
+    Yields the (groupid, torrentid) candidates which aren't known to be
+    missing from data_dir, calling on_missing(groupid, torrentid) for
+    each one which is.
+    '''
+    for groupid, torrentid in candidates:
+        if index.missing(torrentid):
+            index.skipped += 1
+            metrics.inc('library_skips_total')
+            if on_missing is not None:
+                on_missing(groupid, torrentid)
+            continue
+        yield groupid, torrentid
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Maintain the data_dir index used by redactedbetter.')
+    parser.add_argument('--index', help='the location of the library index', default=default_path)
+    parser.add_argument('data_dir')
+    args = parser.parse_args()
+
+    index = LibraryIndex(args.index, os.path.expanduser(args.data_dir))
+    added, removed = index.refresh()
+    entries, torrents, missing = index.counts()
+    print '%d names in data_dir (%d new, %d gone); %d torrents known, %d of them missing' % (
+        entries, added, removed, torrents, missing)
+    index.close()
+
+if __name__ == "__main__": main()
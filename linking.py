@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''
+Puts files into new release directories without copying them where
+possible.
+
+A Linker tries, in order, the methods allowed by its strategy:
+
+* reflink: clone the file's extents (the FICLONE ioctl), which shares
+  the data on copy-on-write filesystems such as btrfs and XFS, so
+  later changes to either file don't affect the other;
+* hardlink: a second name for the same file, if both directories are
+  on the same device;
+* copy: an ordinary byte copy.
+
+It keeps count of the bytes which didn't need copying.
+'''
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+AUTO = 'auto'
+
+# The methods each strategy tries, in order.
+strategies = {
+    AUTO: (REFLINK, HARDLINK, COPY),
+    REFLINK: (REFLINK, COPY),
+    HARDLINK: (HARDLINK, COPY),
+    COPY: (COPY,),
+}
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors meaning a method isn't available for this pair of files,
+# rather than that something is actually wrong.
+unsupported_errors = frozenset([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                                errno.EPERM, errno.EMLINK, errno.ENOSYS])
+
+class Linker(object):
+    def __init__(self, strategy=AUTO):
+        if strategy not in strategies:
+            raise ValueError('Unknown link strategy "%s"' % strategy)
+        self.strategy = strategy
+        self.methods = strategies[strategy]
+        self._lock = threading.Lock()
+        # Files and bytes handled by each method.
+        self.files = dict((method, 0) for method in strategies[AUTO])
+        self.bytes = dict((method, 0) for method in strategies[AUTO])
+
+    def link(self, src, dst):
+        '''
+        Puts src at dst (or in dst, if it's a directory) using the first
+        method that works, and returns the new path.
+        '''
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        size = os.path.getsize(src)
+        for method in self.methods:
+            if method == REFLINK:
+                done = reflink(src, dst)
+            elif method == HARDLINK:
+                done = hardlink(src, dst)
+            else:
+                shutil.copy(src, dst)
+                done = True
+            if done:
+                with self._lock:
+                    self.files[method] += 1
+                    self.bytes[method] += size
+                return dst
+
+    def saved(self):
+        '''
+        Returns the number of bytes which were linked rather than copied.
+        '''
+        with self._lock:
+            return self.bytes[REFLINK] + self.bytes[HARDLINK]
+
+    def summary(self):
+        return ', '.join('%s %d files (%.1f MB)' % (method, self.files[method], self.bytes[method] / 1048576.0)
+                         for method in strategies[AUTO] if self.files[method])
+
+def reflink(src, dst):
+    '''
+    Clones src to dst, replacing it if it exists. Returns False, leaving
+    nothing behind, if the filesystem can't; raises on other errors,
+    also leaving nothing behind.
+    '''
+    with open(src, 'rb') as source:
+        try:
+            with open(dst, 'wb') as dest:
+                try:
+                    fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+                except IOError as e:
+                    if e.errno not in unsupported_errors:
+                        raise
+                    failed = True
+                else:
+                    failed = False
+            if not failed:
+                shutil.copymode(src, dst)
+        except:
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+    if failed:
+        os.remove(dst)
+        return False
+    return True
+
+def hardlink(src, dst):
+    '''
+    Links src to dst, replacing it if it exists, as a copy would.
+    Returns False if they're on different devices or the filesystem
+    doesn't support hard links.
+    '''
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            if os.path.samefile(src, dst):
+                return True
+            os.remove(dst)
+            return hardlink(src, dst)
+        if e.errno not in unsupported_errors:
+            raise
+        return False
+    return True
+
+# Used by callers which weren't given a Linker. Hard links share the
+# file with the torrent being seeded, so only the link_strategy option
+# turns them on.
+default_linker = Linker(COPY)
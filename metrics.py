@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''
+Counters and timing histograms for redactedbetter runs.
+
+Every metric is defined in `definitions` below, and recorded in the
+module-level registry by name and labels:
+
+    metrics.inc('api_requests_total', action='torrentgroup')
+    with metrics.timer('stage_seconds', stage='upload'):
+        ...
+
+Transcode pool workers record into their own copy of the registry;
+TranscodePool sends what each job recorded back to the parent with
+its result, where it is merged in.
+
+At the end of a run the registry can be printed as a summary table,
+appended to a file as JSON lines, or written as a Prometheus textfile
+(for node_exporter's textfile collector).
+'''
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# Bucket upper bounds, in seconds for timings.
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ratio_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+definitions = {
+    'api_requests_total': (COUNTER, 'AJAX requests made, by action', None),
+    'api_cache_hits_total': (COUNTER, 'AJAX requests answered by the response cache, by action', None),
+    'relogins_total': (COUNTER, 'Times the site turned down the session and we logged in again', None),
+    'http_request_seconds': (HISTOGRAM, 'Time taken by each request to the site, by method and page', time_buckets),
+    'ratelimit_wait_seconds': (HISTOGRAM, 'Time spent waiting on the rate limiter before each request', time_buckets),
+    'snatched_page_seconds': (HISTOGRAM, 'Time taken to fetch and parse each page of the snatched list', time_buckets),
+    'probe_seconds': (HISTOGRAM, 'Time taken to read the stream info and tags of a release', time_buckets),
+    'stage_seconds': (HISTOGRAM, 'Time spent in each stage of handling a release', time_buckets),
+    'transcode_file_seconds': (HISTOGRAM, 'Time taken by the decode/encode pipeline for each file, by format', time_buckets),
+    'tag_seconds': (HISTOGRAM, 'Time taken to copy and check the tags of each transcoded file, by format', time_buckets),
+    'encode_realtime_factor': (HISTOGRAM, 'Seconds of audio transcoded per second, for each file, by format', ratio_buckets),
+    'concurrency_changes_total': (COUNTER, 'Changes to the number of files transcoded at once, by direction', None),
+    'encode_cache_total': (COUNTER, 'Files looked up in the encode cache, by format and result', None),
+    'releases_total': (COUNTER, 'Releases handled, by outcome', None),
+    'library_skips_total': (COUNTER, 'Snatches passed over without a request, as the library index knows their files are gone', None),
+    'uploads_total': (COUNTER, 'Torrents added, by format', None),
+}
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, state):
+        for i, count in enumerate(state['counts']):
+            self.counts[i] += count
+        self.count += state['count']
+        self.sum += state['sum']
+        for attr, fn in (('min', min), ('max', max)):
+            if state[attr] is not None:
+                mine = getattr(self, attr)
+                setattr(self, attr, state[attr] if mine is None else fn(mine, state[attr]))
+
+    def state(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+    def quantile(self, q):
+        '''
+        Estimates a quantile from the buckets, as the upper bound of
+        the bucket it falls in (or the maximum, for the last one).
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def _key(self, name, labels):
+        if name not in definitions:
+            raise KeyError('Undefined metric %s' % name)
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(definitions[name][2])
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def drain(self):
+        '''
+        Returns everything recorded so far, in a picklable form for
+        merge(), and resets the registry.
+        '''
+        with self._lock:
+            samples = (list(self.counters.items()),
+                       [(key, histogram.state()) for key, histogram in self.histograms.items()])
+            self.counters = {}
+            self.histograms = {}
+        return samples
+
+    def merge(self, samples):
+        counters, histograms = samples
+        with self._lock:
+            for key, value in counters:
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, state in histograms:
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(definitions[key[0]][2])
+                self.histograms[key].merge(state)
+
+    def summary(self):
+        '''
+        Returns a table of every histogram and counter.
+        '''
+        with self._lock:
+            lines = ['%-24s %-30s %7s %10s %9s %9s %9s' % ('metric', 'labels', 'count', 'total', 'mean', 'p90', 'max')]
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append('%-24s %-30s %7d %10.2f %9.3f %9.3f %9.3f' % (
+                    name, format_labels(labels), histogram.count, histogram.sum,
+                    histogram.sum / histogram.count, histogram.quantile(0.9), histogram.max))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%-24s %-30s %7d' % (name, format_labels(labels), value))
+        return '\n'.join(lines)
+
+    def write_json_lines(self, path, **extra):
+        '''
+        Appends one JSON object per metric to path, each with the time
+        and any extra fields given (e.g., a run id).
+        '''
+        now = time.time()
+        with self._lock:
+            records = []
+            for (name, labels), value in sorted(self.counters.items()):
+                records.append(dict(extra, time=now, metric=name, type=COUNTER, labels=dict(labels), value=value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                record = dict(extra, time=now, metric=name, type=HISTOGRAM, labels=dict(labels))
+                record.update(histogram.state())
+                record['buckets'] = list(histogram.buckets) + ['+Inf']
+                records.append(record)
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path, prefix='redactedbetter_'):
+        '''
+        Writes the metrics in the Prometheus text format, replacing path
+        atomically so a collector never reads half a file.
+        '''
+        lines = []
+        with self._lock:
+            for name in sorted(definitions):
+                kind, help, buckets = definitions[name]
+                if kind == COUNTER:
+                    samples = [(labels, value) for (n, labels), value in sorted(self.counters.items()) if n == name]
+                else:
+                    samples = [(labels, h) for (n, labels), h in sorted(self.histograms.items()) if n == name]
+                if not samples:
+                    continue
+                lines.append('# HELP %s%s %s' % (prefix, name, help))
+                lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+                for labels, value in samples:
+                    if kind == COUNTER:
+                        lines.append('%s%s%s %s' % (prefix, name, prometheus_labels(labels), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], value.counts):
+                        cumulative += count
+                        lines.append('%s%s_bucket%s %d' % (prefix, name, prometheus_labels(labels + (('le', str(bound)),)), cumulative))
+                    lines.append('%s%s_sum%s %r' % (prefix, name, prometheus_labels(labels), value.sum))
+                    lines.append('%s%s_count%s %d' % (prefix, name, prometheus_labels(labels), value.count))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, path)
+
+def format_labels(labels):
+    return ','.join('%s=%s' % (key, value) for key, value in labels)
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+
+registry = Registry()
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
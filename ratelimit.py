@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Request rate limiting for redactedbetter.
+
+The site allows a fixed number of requests within any sliding window
+(5 requests per 10 seconds at the time of writing). Rather than
+spacing every request evenly, we keep the timestamps of the most
+recent requests and only block when another request would exceed the
+window, so short bursts go out immediately. FileRateLimiter keeps that
+history in a locked file so the budget is shared between processes.
+'''
+import collections
+import errno
+import fcntl
+import os
+import threading
+import time
+
+# API use is limited to 5 requests within any 10-second window.
+DEFAULT_REQUESTS = 5
+DEFAULT_WINDOW = 10.0
+
+class RateLimiter(object):
+    '''
+    Thread-safe sliding window rate limiter.
+
+    Call wait() before every request; it blocks until the request may
+    be made and returns the number of seconds it spent waiting.
+    '''
+    def __init__(self, requests=DEFAULT_REQUESTS, window=DEFAULT_WINDOW, clock=time.time, sleep=time.sleep):
+        if requests < 1:
+            raise ValueError('requests must be at least 1')
+        self.requests = requests
+        self.window = float(window)
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+        self._history = collections.deque()
+        self._lock = threading.Lock()
+
+    def _delay(self, now):
+        '''
+        Returns how long a request made at `now` has to wait, and
+        forgets requests which have left the window.
+        '''
+        while self._history and now - self._history[0] >= self.window:
+            self._history.popleft()
+        if len(self._history) < self.requests:
+            return 0.0
+        return self._history[0] + self.window - now
+
+    def wait(self):
+        '''
+        Blocks until another request fits in the window, records it
+        and returns the time spent waiting, in seconds.
+        '''
+        with self._lock:
+            waited = self._reserve()
+            self.calls += 1
+            self.total_wait += waited
+            self.last_wait = waited
+        return waited
+
+    def _reserve(self):
+        # Holding the lock while sleeping serializes waiters, so
+        # they are released in arrival order.
+        start = now = self.clock()
+        delay = self._delay(now)
+        while delay > 0:
+            self.sleep(delay)
+            now = self.clock()
+            delay = self._delay(now)
+        self._history.append(now)
+        return now - start
+
+    def stats(self):
+        '''
+        Returns (calls, total seconds waited).
+        '''
+        return self.calls, self.total_wait
+
+class FileRateLimiter(RateLimiter):
+    '''
+    Rate limiter shared by every process on the host.
+
+    The request history lives in a small file which is locked with
+    flock() for the duration of each wait(), so any number of
+    redactedbetter and torrent-crawl processes pointed at the same
+    file stay within a single site-wide budget. Waiters block on the
+    lock rather than polling it.
+    '''
+    def __init__(self, path, requests=DEFAULT_REQUESTS, window=DEFAULT_WINDOW, clock=time.time, sleep=time.sleep):
+        super(FileRateLimiter, self).__init__(requests, window, clock, sleep)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _reserve(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                self._history = collections.deque(self._parse(f.read()))
+                waited = super(FileRateLimiter, self)._reserve()
+                f.seek(0)
+                f.truncate()
+                f.write(''.join('%.6f\n' % stamp for stamp in self._history))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return waited
+
+    def _parse(self, content):
+        stamps = []
+        for line in content.split():
+            try:
+                stamps.append(float(line))
+            except ValueError:
+                # A process died mid-write; the other entries are
+                # still good.
+                pass
+        # Only the most recent entries can affect the next request.
+        return sorted(stamps)[-self.requests:]
@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 import re
 import os
+import errno
 import json
+import threading
 import time
+import urlparse
 import requests
 import mechanize
 import HTMLParser
 from cStringIO import StringIO
 
+import metrics
+from formtemplate import FormTemplate, FormTemplateError
+from ratelimit import RateLimiter
+
 headers = {
     'Connection': 'keep-alive',
     'Cache-Control': 'max-age=0',
@@ -31,6 +38,8 @@ media_search_map = {
 
 lossless_media = set(media_search_map.keys())
 
+default_site_url = 'https://redacted.ch/'
+
 formats = {
     'FLAC': {
         'format': 'FLAC',
@@ -58,44 +67,169 @@ def allowed_transcodes(torrent):
     else:
         return formats.keys()
 
+# Fields of upload.php's form which upload() fills in.
+upload_fields = ('auth', 'groupid', 'remaster_year', 'remaster_title', 'remaster_record_label',
+                 'remaster_catalogue_number', 'format', 'bitrate', 'media', 'release_desc')
+
 class LoginException(Exception):
     pass
 
+class SessionFile(object):
+    '''
+    Keeps a logged in session (its cookies, authkey, passkey and user
+    id) in a file only the user can read, so later runs can carry on
+    with it rather than logging in again.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''
+        Returns the saved session, or None if there isn't one.
+        '''
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, session):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Create it unreadable to anyone else, then replace the old one
+        # atomically.
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def is_login_redirect(response):
+    '''
+    Returns whether the site sent us to the login page, as it does when
+    it no longer accepts our session.
+    '''
+    if response.status_code in (301, 302, 303, 307):
+        return 'login.php' in response.headers.get('location', '')
+    # A redirect we followed.
+    return bool(response.history) and urlparse.urlparse(response.url).path.endswith('login.php')
+
 class RequestException(Exception):
     pass
 
 class RedactedAPI:
-    def __init__(self, username=None, password=None, session_cookie=None):
+    def __init__(self, username=None, password=None, session_cookie=None, limiter=None, cache=None,
+                 site_url=default_site_url, session_file=None):
         self.session = requests.Session()
         self.session.headers.update(headers)
         self.username = username
         self.password = password
         self.session_cookie = session_cookie
+        self.site_url = site_url
         self.authkey = None
         self.passkey = None
         self.userid = None
         self.tracker = "https://flacsfor.me/"
-        self.last_request = time.time()
-        self.rate_limit = 2.0 # seconds between requests
-        self._login()
+        if limiter is None:
+            limiter = RateLimiter()
+        self.limiter = limiter
+        self.cache = cache
+        # Form templates by name, backed by the response cache.
+        self.forms = {}
+        self.session_file = SessionFile(session_file) if session_file else None
+        # The pipeline's threads share the session, so logging in again
+        # is done by one thread at a time. The generation counts logins,
+        # so a thread which was turned down by a session another thread
+        # has since replaced just tries again with the new one.
+        self._login_lock = threading.Lock()
+        self._generation = 0
+        # Set in the thread which is logging in.
+        self._local = threading.local()
+        if not self._restore_session():
+            self._login()
 
     def _login(self):
-        if self.session_cookie is not None:
-            try:
-                self._login_cookie()
-            except:
-                print "WARNING: session cookie attempted and failed"
+        self._local.logging_in = True
+        try:
+            if self.session_cookie is not None:
+                try:
+                    self._login_cookie()
+                except:
+                    print "WARNING: session cookie attempted and failed"
+                    self._login_username_password()
+            else:
                 self._login_username_password()
-        else:
-            self._login_username_password()
+        finally:
+            self._local.logging_in = False
+        self._generation += 1
+        self._save_session()
+
+    def _session_owner(self):
+        # A saved session is only any good to the same user on the same
+        # site.
+        return {'site_url': self.site_url, 'username': self.username, 'session_cookie': self.session_cookie}
+
+    def _restore_session(self):
+        '''
+        Carries on with the saved session, if there's one for this user.
+        It's only checked when the site next turns it down (see _send()).
+        '''
+        if self.session_file is None:
+            return False
+        saved = self.session_file.load()
+        if not saved or saved.get('owner') != self._session_owner():
+            return False
+        for cookie in saved['cookies']:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+        self.authkey = saved['authkey']
+        self.passkey = saved['passkey']
+        self.userid = saved['userid']
+        return True
+
+    def _save_session(self):
+        if self.session_file is None:
+            return
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path} for c in self.session.cookies]
+        self.session_file.save({
+            'owner': self._session_owner(),
+            'cookies': cookies,
+            'authkey': self.authkey,
+            'passkey': self.passkey,
+            'userid': self.userid,
+            'saved': time.time(),
+        })
+
+    def _relogin(self, generation):
+        '''
+        Logs in again, unless another thread already has since the
+        session of the given generation was turned down.
+        '''
+        with self._login_lock:
+            if self._generation != generation:
+                return
+            print 'The site turned down our session, logging in again...'
+            metrics.inc('relogins_total')
+            if self.session_file is not None:
+                self.session_file.clear()
+            self.session.cookies.clear()
+            self.authkey = None
+            self._login()
 
     def _login_cookie(self):
-        mainpage = 'https://redacted.ch/';
+        mainpage = self.site_url
         cookiedict = {"session": self.session_cookie}
         cookies = requests.utils.cookiejar_from_dict(cookiedict)
 
         self.session.cookies.update(cookies)
-        r = self.session.get(mainpage)
+        r = self._get(mainpage)
         try:
             accountinfo = self.request('index')
             self.authkey = accountinfo['authkey']
@@ -110,10 +244,10 @@ class RedactedAPI:
         if not self.username or self.username == "":
             print "WARNING: username authentication attempted, but username not set, skipping."
             raise LoginException
-        loginpage = 'https://redacted.ch/login.php'
+        loginpage = self.site_url + 'login.php'
         data = {'username': self.username,
                 'password': self.password}
-        r = self.session.post(loginpage, data=data)
+        r = self._post(loginpage, data=data)
         if r.status_code != 200:
             raise LoginException
         try:
@@ -124,38 +258,91 @@ class RedactedAPI:
         except:
             raise LoginException
 
-    def logout(self):
-        self.session.get("https://redacted.ch/logout.php?auth=%s" % self.authkey)
+    def _get(self, url, **kwargs):
+        '''Rate limited GET; every request to the site goes through here or _post'''
+        return self._send('GET', url, **kwargs)
+
+    def _post(self, url, **kwargs):
+        '''Rate limited POST'''
+        return self._send('POST', url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        generation = self._generation
+        response = self._send_once(method, url, **kwargs)
+        if getattr(self._local, 'logging_in', False) or not is_login_redirect(response):
+            return response
+        # Our session has expired or been revoked.
+        self._relogin(generation)
+        if method != 'GET':
+            # Not safe to repeat here; the caller sees it failed.
+            return response
+        params = kwargs.get('params')
+        if isinstance(params, dict) and 'auth' in params:
+            kwargs['params'] = dict(params, auth=self.authkey)
+        response = self._send_once(method, url, **kwargs)
+        if is_login_redirect(response):
+            raise LoginException
+        return response
 
-    def request(self, action, **kwargs):
-        '''Makes an AJAX request at a given action page'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
+    def _send_once(self, method, url, **kwargs):
+        metrics.observe('ratelimit_wait_seconds', self.limiter.wait())
+        page = os.path.basename(urlparse.urlparse(url).path) or 'index'
+        with metrics.timer('http_request_seconds', method=method, page=page):
+            return self.session.request(method, url, **kwargs)
 
-        ajaxpage = 'https://redacted.ch/ajax.php'
+    def logout(self):
+        self._get(self.site_url + "logout.php?auth=%s" % self.authkey)
+
+    def request(self, action, cached=True, **kwargs):
+        '''
+        Makes an AJAX request at a given action page. With cached=False,
+        the response cache isn't read (but is updated), for when the
+        answer has to be current.
+        '''
+        if cached:
+            response = self.cached_response(action, **kwargs)
+            if response is not None:
+                return response
+
+        ajaxpage = self.site_url + 'ajax.php'
         params = {'action': action}
         if self.authkey:
             params['auth'] = self.authkey
         params.update(kwargs)
-        r = self.session.get(ajaxpage, params=params, allow_redirects=False)
-        self.last_request = time.time()
+        metrics.inc('api_requests_total', action=action)
+        r = self._get(ajaxpage, params=params, allow_redirects=False)
         try:
             parsed = json.loads(r.content)
             if parsed['status'] != 'success':
                 raise RequestException
-            return parsed['response']
         except ValueError:
             raise RequestException
+        if self.cache is not None:
+            self.cache.put(action, parsed['response'], **kwargs)
+        return parsed['response']
+
+    def cached_response(self, action, **kwargs):
+        '''
+        Returns the cached response for a request, or None if there
+        isn't one.
+        '''
+        if self.cache is None:
+            return None
+        response = self.cache.get(action, **kwargs)
+        if response is not None:
+            metrics.inc('api_cache_hits_total', action=action)
+        return response
+
+    def invalidate(self, action, **kwargs):
+        '''Forgets any cached response for the given request'''
+        if self.cache is not None:
+            self.cache.invalidate(action, **kwargs)
 
     def request_html(self, action, **kwargs):
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
-        ajaxpage = 'https://redacted.ch/' + action
+        ajaxpage = self.site_url + action
         if self.authkey:
             kwargs['auth'] = self.authkey
-        r = self.session.get(ajaxpage, params=kwargs, allow_redirects=False)
-        self.last_request = time.time()
+        r = self._get(ajaxpage, params=kwargs, allow_redirects=False)
         return r.content
 
     def get_artist(self, id=None, format='MP3', best_seeded=True):
@@ -180,7 +367,18 @@ class RedactedAPI:
         res['torrentgroup'] = keep_releases
         return res
 
-    def snatched(self, skip=None, media=lossless_media):
+    def snatched(self, skip=None, media=lossless_media, sync=None, full=False):
+        '''
+        Yields (groupid, torrentid) for every snatched FLAC not in skip.
+
+        If sync is given (see statestore.StateStore.get_sync and
+        set_sync), progress through each list is recorded. The snatched
+        list is newest first, so once a full sweep has finished, later
+        calls only page until they reach the newest torrent seen by that
+        sweep (the high-water mark). An interrupted full sweep resumes
+        from the page it stopped at. Pass full=True to sweep every page
+        regardless.
+        '''
         if not media.issubset(lossless_media):
             raise ValueError('Unsupported media type %s' % (media - lossless_media).pop())
 
@@ -190,60 +388,153 @@ class RedactedAPI:
         # a 'media' parameter (defaults to all types).
 
         if media == lossless_media:
-            media_params = ['']
+            media_params = [('all', '')]
         else:
-            media_params = ['&media=%s' % media_search_map[m] for m in media]
-
-        url = 'https://redacted.ch/torrents.php?type=snatched&userid=%s&format=FLAC' % self.userid
-        for mp in media_params:
-            page = 1
+            media_params = [(m, '&media=%s' % media_search_map[m]) for m in media]
+
+        url = self.site_url + 'torrents.php?type=snatched&userid=%s&format=FLAC' % self.userid
+        pattern = re.compile('torrents.php\?id=(\d+)&amp;torrentid=(\d+)')
+        for m, mp in media_params:
+            key = 'snatched:%s:%s' % (self.userid, m)
+            high_water, cursor, sweep_top = (None, None, None) if sync is None else sync.get_sync(key)
+            delta = high_water is not None and cursor is None and not full
+            if cursor is None:
+                cursor, sweep_top = 1, None
+            page = 1 if delta else cursor
             done = False
-            pattern = re.compile('torrents.php\?id=(\d+)&amp;torrentid=(\d+)')
             while not done:
-                content = self.session.get(url + mp + "&page=%s" % page).text
-                for groupid, torrentid in pattern.findall(content):
-                    if skip is None or torrentid not in skip:
-                        yield int(groupid), int(torrentid)
-                done = 'Next &gt;' not in content
+                start = time.time()
+                content = self._get(url + mp + "&page=%s" % page).text
+                found = [(int(groupid), int(torrentid)) for groupid, torrentid in pattern.findall(content)]
+                metrics.observe('snatched_page_seconds', time.time() - start)
+                if page == 1 and found:
+                    sweep_top = found[0][1]
+                reached = False
+                for groupid, torrentid in found:
+                    if delta and torrentid == high_water:
+                        reached = True
+                        break
+                    if skip is None or str(torrentid) not in skip:
+                        yield groupid, torrentid
+                done = reached or 'Next &gt;' not in content
                 page += 1
-
-    def upload(self, group, torrent, new_torrent, format, description=[]):
-        url = "https://redacted.ch/upload.php?groupid=%s" % group['group']['id']
-        response = self.session.get(url)
+                if sync is not None and not delta:
+                    if done:
+                        sync.set_sync(key, sweep_top, None, None)
+                    else:
+                        sync.set_sync(key, high_water, page, sweep_top)
+            if sync is not None and delta:
+                sync.set_sync(key, sweep_top if sweep_top is not None else high_water, None, None)
+
+    def upload_form(self, groupid, refresh=False):
+        '''
+        Returns (template, fresh) for the upload form. The form's layout
+        is learned from upload.php once and then cached, with neutral
+        defaults (see formtemplate); fresh is True if it was fetched
+        just now, for this group, or refresh was set.
+        '''
+        if not refresh:
+            template = self.forms.get('upload')
+            if template is None and self.cache is not None:
+                stored = self.cache.get('form', name='upload')
+                if stored is not None:
+                    try:
+                        template = FormTemplate.from_dict(stored, upload_fields)
+                    except FormTemplateError:
+                        template = None
+            if template is not None and template.file_control is not None:
+                self.forms['upload'] = template
+                return template, False
+
+        url = self.site_url + "upload.php?groupid=%s" % groupid
+        response = self._get(url)
         forms = mechanize.ParseFile(StringIO(response.text.encode('utf-8')), url)
-        form = forms[-1]
-        form.find_control('file_input').add_file(open(new_torrent), 'application/x-bittorrent', os.path.basename(new_torrent))
-        #if torrent['remastered']:
-        #    form.find_control('remaster').set_single('1')
-        form['remaster_year'] = str(torrent['remasterYear'])
-        form['remaster_title'] = torrent['remasterTitle']
-        form['remaster_record_label'] = torrent['remasterRecordLabel']
-        form['remaster_catalogue_number'] = torrent['remasterCatalogueNumber']
-        form.find_control('format').set('1', formats[format]['format'])
-        form.find_control('bitrate').set('1', formats[format]['encoding'])
-        form.find_control('media').set('1', torrent['media'])
+        template = FormTemplate.from_form(forms[-1])
+        template.require(upload_fields)
+        if template.file_control is None:
+            raise FormTemplateError('Upload form has no file field')
+        # This group's defaults are only good for this upload.
+        layout = FormTemplate.from_form(forms[-1], neutral=True)
+        self.forms['upload'] = layout
+        if self.cache is not None:
+            self.cache.put('form', layout.to_dict(), name='upload')
+        return template, True
+
+    def forget_upload_form(self):
+        self.forms.pop('upload', None)
+        self.invalidate('form', name='upload')
 
+    def upload(self, group, torrent, new_torrent, format, description=[]):
+        groupid = group['group']['id']
+        url = self.site_url + "upload.php?groupid=%s" % groupid
+        values = {
+            'groupid': str(groupid),
+            #'remaster': '1' if torrent['remastered'] else None,
+            'remaster_year': str(torrent['remasterYear']),
+            'remaster_title': torrent['remasterTitle'],
+            'remaster_record_label': torrent['remasterRecordLabel'],
+            'remaster_catalogue_number': torrent['remasterCatalogueNumber'],
+            'format': formats[format]['format'],
+            'bitrate': formats[format]['encoding'],
+            'media': torrent['media'],
+        }
         release_desc = '\n'.join(description)
         if release_desc:
-            form['release_desc'] = release_desc
+            values['release_desc'] = release_desc
 
-        _, data, headers = form.click_request_data()
-        return self.session.post(url, data=data, headers=dict(headers))
+        template, fresh = self.upload_form(groupid)
+        relogged = False
+        while True:
+            # The authkey changes if we had to log in again.
+            values['auth'] = self.authkey
+            try:
+                data = template.fill(values)
+            except FormTemplateError:
+                if fresh:
+                    raise
+                template, fresh = self.upload_form(groupid, refresh=True)
+                continue
+            with open(new_torrent, 'rb') as f:
+                files = {template.file_control: (os.path.basename(new_torrent), f, 'application/x-bittorrent')}
+                response = self._post(url, data=data, files=files, allow_redirects=False)
+            # A successful upload redirects to the new torrent; a
+            # rejected one shows the form again.
+            uploaded = response.status_code in (301, 302, 303) and 'torrents.php' in response.headers.get('location', '')
+            if is_login_redirect(response) and not relogged:
+                # The upload wasn't looked at; _send() has logged in
+                # again, so try again as the new session.
+                relogged = True
+                continue
+            break
+
+        self.invalidate('torrentgroup', id=groupid)
+        if not uploaded:
+            # Never post the torrent twice: the server has answered, and
+            # may have taken it. If the cached form was to blame, the
+            # next upload learns it again.
+            if not fresh:
+                self.forget_upload_form()
+            raise RequestException('Upload rejected by upload.php')
+        return response
 
     def set_24bit(self, torrent):
-        url = "https://redacted.ch/torrents.php?action=edit&id=%s" % torrent['id']
-        response = self.session.get(url)
+        url = self.site_url + "torrents.php?action=edit&id=%s" % torrent['id']
+        response = self._get(url)
         forms = mechanize.ParseFile(StringIO(response.text.encode('utf-8')), url)
         form = forms[-3]
         form.find_control('bitrate').set('1', '24bit Lossless')
         _, data, headers = form.click_request_data()
-        return self.session.post(url, data=data, headers=dict(headers))
+        response = self._post(url, data=data, headers=dict(headers))
+        # The torrent's group has changed too, but we don't know its
+        # id here; callers should invalidate it.
+        self.invalidate('torrent', id=torrent['id'])
+        return response
 
     def release_url(self, group, torrent):
-        return "https://redacted.ch/torrents.php?id=%s&torrentid=%s#torrent%s" % (group['group']['id'], torrent['id'], torrent['id'])
+        return self.site_url + "torrents.php?id=%s&torrentid=%s#torrent%s" % (group['group']['id'], torrent['id'], torrent['id'])
 
     def permalink(self, torrent):
-        return "https://redacted.ch/torrents.php?torrentid=%s" % torrent['id']
+        return self.site_url + "torrents.php?torrentid=%s" % torrent['id']
 
     def get_better(self, search_type=3, tags=None):
         if tags is None:
@@ -260,17 +551,12 @@ class RedactedAPI:
 
     def get_torrent(self, torrent_id):
         '''Downloads the torrent at torrent_id using the authkey and passkey'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
-        torrentpage = 'https://redacted.ch/torrents.php'
+        torrentpage = self.site_url + 'torrents.php'
         params = {'action': 'download', 'id': torrent_id}
         if self.authkey:
             params['authkey'] = self.authkey
             params['torrent_pass'] = self.passkey
-        r = self.session.get(torrentpage, params=params, allow_redirects=False)
-
-        self.last_request = time.time() + 2.0
+        r = self._get(torrentpage, params=params, allow_redirects=False)
         if r.status_code == 200 and 'application/x-bittorrent' in r.headers['content-type']:
             return r.content
         return None
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+'''
+Release probing for redactedbetter.
+
+A ReleaseProbe walks a release directory once and reads each FLAC's
+stream info and tags once, then answers every question the transcode
+and pre-flight code has about the release from memory. A ProbeIndex
+remembers what was read across runs, so unchanged files don't have to
+be read at all.
+'''
+import os
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import mutagen.flac
+
+import metrics
+import tagging
+
+class FileInfo(object):
+    '''
+    The stream info of a single FLAC file. Attributes are named after
+    mutagen's StreamInfo, so either can be passed to the transcode
+    functions. Unlike mutagen's objects, these can be pickled.
+    '''
+    def __init__(self, path, bits_per_sample, sample_rate, channels, length, md5_signature):
+        self.path = path
+        self.bits_per_sample = bits_per_sample
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.length = length
+        self.md5_signature = md5_signature
+
+    @classmethod
+    def from_flac(cls, path, flac):
+        info = flac.info
+        return cls(path, info.bits_per_sample, info.sample_rate, info.channels, info.length, info.md5_signature)
+
+class ProbeIndex(object):
+    '''
+    Persistent store of FileInfo and tag check results, keyed by path,
+    size and modification time. An entry whose file has changed size
+    or mtime is simply ignored and replaced.
+    '''
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                bits_per_sample INTEGER NOT NULL,
+                sample_rate INTEGER NOT NULL,
+                channels INTEGER NOT NULL,
+                length REAL NOT NULL,
+                md5_signature TEXT NOT NULL,
+                tags_ok INTEGER NOT NULL,
+                tags_msg TEXT)''')
+
+    def lookup(self, path, st):
+        '''
+        Returns (FileInfo, tag check result) for path, given its
+        os.stat() result, or None if the index has nothing current.
+        '''
+        with self._lock:
+            row = self._db.execute('''SELECT bits_per_sample, sample_rate, channels, length, md5_signature, tags_ok, tags_msg
+                FROM files WHERE path = ? AND size = ? AND mtime = ?''', (path, st.st_size, st.st_mtime)).fetchone()
+        if row is None:
+            return None
+        bits_per_sample, sample_rate, channels, length, md5_signature, tags_ok, tags_msg = row
+        info = FileInfo(path, bits_per_sample, sample_rate, channels, length, int(md5_signature, 16))
+        return info, (bool(tags_ok), tags_msg)
+
+    def store(self, entries):
+        '''
+        Stores a list of (FileInfo, tag check result, os.stat() result)
+        entries.
+        '''
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(info.path, st.st_size, st.st_mtime, info.bits_per_sample, info.sample_rate, info.channels,
+                      info.length, '%032x' % info.md5_signature, int(tags[0]), tags[1]) for info, tags, st in entries])
+
+    def invalidate(self, directory):
+        '''
+        Forgets every file within directory.
+        '''
+        directory = os.path.join(os.path.abspath(directory), '')
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(directory), directory))
+
+    def prune(self):
+        '''
+        Forgets files which no longer exist, returning how many there
+        were.
+        '''
+        with self._lock:
+            paths = [path for (path,) in self._db.execute('SELECT path FROM files')]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM files WHERE path = ?', missing)
+        return len(missing)
+
+    def rebuild(self, data_dir, threads=1):
+        '''
+        Probes every release in data_dir, single-file FLAC torrents at
+        its top level included, so later runs can skip reading their
+        FLACs. Returns the number of FLACs probed.
+        '''
+        count = 0
+        singles = []
+        for name in sorted(os.listdir(data_dir)):
+            path = os.path.join(data_dir, name)
+            if os.path.isdir(path):
+                count += len(ReleaseProbe(path, threads, self).flac_files)
+            elif os.path.splitext(name)[-1].lower() == '.flac' and not name.startswith('.'):
+                singles.append(path)
+        if singles:
+            count += len(ReleaseProbe(data_dir, threads, self, paths=singles).flac_files)
+        return count
+
+    def close(self):
+        self._db.close()
+
+class ReleaseProbe(object):
+    def __init__(self, flac_dir, threads=1, index=None, paths=None):
+        '''
+        Probes the files in flac_dir, or if paths is given, just those.
+        '''
+        start = time.time()
+        self.flac_dir = os.path.abspath(flac_dir)
+        if paths is not None:
+            self.paths = [os.path.abspath(path) for path in paths]
+        else:
+            self.paths = []
+            for path, dirs, files in os.walk(self.flac_dir):
+                for filename in files:
+                    # Like transcode.locate(), skip dotfiles.
+                    if not filename.startswith('.'):
+                        self.paths.append(os.path.abspath(os.path.join(path, filename)))
+
+        self.flac_files = self.files('.flac')
+        # FileInfo by path, and the tag check result (for
+        # check_tracknumber_format=False) by path.
+        self.info = {}
+        self.tags = {}
+        # The first exception raised while reading a FLAC, if any.
+        self.error = None
+
+        stats = {}
+        to_read = []
+        for path in self.flac_files:
+            if index is not None:
+                stats[path] = st = os.stat(path)
+                entry = index.lookup(path, st)
+                if entry is not None:
+                    self.info[path], self.tags[path] = entry
+                    continue
+            to_read.append(path)
+
+        if threads > 1 and len(to_read) > 1:
+            pool = ThreadPool(min(threads, len(to_read)))
+            try:
+                results = pool.map(self._read, to_read)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(self._read, to_read)
+
+        for path, info, tags, error in results:
+            if error is not None:
+                if self.error is None:
+                    self.error = error
+                continue
+            self.info[path] = info
+            self.tags[path] = tags
+
+        if index is not None:
+            index.store([(self.info[path], self.tags[path], stats[path]) for path in to_read if path in self.info])
+        metrics.observe('probe_seconds', time.time() - start)
+
+    def _read(self, path):
+        try:
+            flac = mutagen.flac.FLAC(path)
+            tags = tagging.check_tags(path, check_tracknumber_format=False, info=flac)
+            return path, FileInfo.from_flac(path, flac), tags, None
+        except Exception as e:
+            return path, None, None, e
+
+    def files(self, *extensions):
+        '''
+        Returns every file in the release with one of the given
+        extensions, in the order transcode.locate() would find them.
+        '''
+        return [path for path in self.paths if os.path.splitext(path)[-1].lower() in extensions]
+
+    def _infos(self):
+        if self.error is not None:
+            raise self.error
+        return [self.info[path] for path in self.flac_files]
+
+    def is_24bit(self):
+        '''
+        Returns True if any FLAC in the release is 24 bit.
+        '''
+        return any(info.bits_per_sample > 16 for info in self._infos())
+
+    def is_multichannel(self):
+        '''
+        Returns True if any FLAC in the release is multichannel.
+        '''
+        try:
+            return any(info.channels > 2 for info in self._infos())
+        except:
+            return False
+
+    def needs_resampling(self):
+        '''
+        Returns True if any FLAC in the release needs resampling when
+        transcoded.
+        '''
+        return self.is_24bit()
+
+    def resample_rate(self):
+        '''
+        Returns the rate to which the release should be resampled.
+        '''
+        original_rate = max(info.sample_rate for info in self._infos())
+        if original_rate % 44100 == 0:
+            return 44100
+        elif original_rate % 48000 == 0:
+            return 48000
+        else:
+            return None
+
+    def check_tags(self):
+        '''
+        Runs tagging.check_tags() on every FLAC (without checking the
+        tracknumber format) and returns the first failure, or (True,
+        None) if they all pass.
+        '''
+        self._infos()
+        for path in self.flac_files:
+            (ok, msg) = self.tags[path]
+            if not ok:
+                return (ok, msg)
+        return (True, None)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Maintain the FLAC probe index used by redactedbetter.')
+    parser.add_argument('--index', help='the location of the probe index',
+            default=os.path.expanduser('~/.redactedbetter/probe.db'))
+    parser.add_argument('-j', '--threads', default=4, type=int)
+    subparsers = parser.add_subparsers(dest='command')
+    rebuild = subparsers.add_parser('rebuild', help='probe every release in a data directory')
+    rebuild.add_argument('data_dir')
+    invalidate = subparsers.add_parser('invalidate', help='forget every file within a directory')
+    invalidate.add_argument('directory')
+    subparsers.add_parser('prune', help='forget files which no longer exist')
+    args = parser.parse_args()
+
+    index = ProbeIndex(args.index)
+    if args.command == 'rebuild':
+        print 'Probed %d FLACs' % index.rebuild(os.path.expanduser(args.data_dir), args.threads)
+    elif args.command == 'invalidate':
+        index.invalidate(os.path.expanduser(args.directory))
+    elif args.command == 'prune':
+        print 'Forgot %d missing files' % index.prune()
+    index.close()
+
+if __name__ == "__main__": main()
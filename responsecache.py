@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Persistent cache for API responses.
+
+Responses are stored in a SQLite database keyed by action and request
+parameters. Each cacheable action has its own time to live, the cache
+is bounded by evicting the least recently used entries, and entries
+can be invalidated explicitly after we change something on the site.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds to keep a response for, per action. Actions not listed here
+# are never cached.
+default_ttls = {
+    'torrentgroup': 6 * 60 * 60,
+    'torrent': 60 * 60,
+    # Form templates; see RedactedAPI.upload_form().
+    'form': 7 * 24 * 60 * 60,
+}
+
+class ResponseCache(object):
+    def __init__(self, path, ttls=None, max_entries=20000, clock=time.time):
+        if ttls is None:
+            ttls = default_ttls
+        self.path = path
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                action TEXT NOT NULL,
+                body TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    def key(self, action, params):
+        '''
+        Returns the cache key for a request. The authkey is not part of
+        the key, since it changes between sessions.
+        '''
+        params = sorted((k, unicode(v)) for k, v in params.items() if k not in ('action', 'auth'))
+        return json.dumps([action, params])
+
+    def cacheable(self, action):
+        return self.ttls.get(action, 0) > 0
+
+    def get(self, action, **params):
+        '''
+        Returns the cached response, or None if there is no fresh
+        entry.
+        '''
+        if not self.cacheable(action):
+            return None
+        key = self.key(action, params)
+        now = self.clock()
+        with self._lock:
+            row = self._db.execute('SELECT body, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttls[action]:
+                self.misses += 1
+                return None
+            with self._db:
+                self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, action, response, **params):
+        if not self.cacheable(action):
+            return
+        key = self.key(action, params)
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO responses (key, action, body, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                                 (key, action, json.dumps(response), now, now))
+                self._evict()
+
+    def _evict(self):
+        (count,) = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()
+        if count > self.max_entries:
+            self._db.execute('''DELETE FROM responses WHERE key IN
+                (SELECT key FROM responses ORDER BY accessed LIMIT ?)''', (count - self.max_entries,))
+
+    def invalidate(self, action, **params):
+        '''
+        Drops the cached response for a request, e.g., after editing or
+        uploading to a group.
+        '''
+        key = self.key(action, params)
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def purge(self):
+        '''
+        Drops every expired entry.
+        '''
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                for action, ttl in self.ttls.items():
+                    self._db.execute('DELETE FROM responses WHERE action = ? AND created < ?', (action, now - ttl))
+                self._db.execute('DELETE FROM responses WHERE action NOT IN (%s)' % ', '.join('?' * len(self.ttls)),
+                                 self.ttls.keys())
+
+    def close(self):
+        self._db.close()
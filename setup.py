@@ -22,7 +22,20 @@ setup(
     url = 'https://github.com/Mechazawa/pthbetter-crawler',
     py_modules = [
         '_version',
+        'concurrency',
+        'crawlqueue',
+        'encodecache',
+        'formtemplate',
+        'jobsocket',
+        'library',
+        'linking',
+        'metrics',
+        'ratelimit',
+        'releaseprobe',
+        'responsecache',
+        'statestore',
         'tagging',
+        'torrentfile',
         'transcode',
         'redactedapi'
     ],
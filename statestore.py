@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''
+Persistent record of the torrents redactedbetter has handled.
+
+Each torrent gets a single row saying what happened to it and when, in
+a SQLite database in WAL mode, so recording a torrent is one small
+transaction however long the history grows, and a crash can't corrupt
+what was already written.
+'''
+import cPickle as pickle
+import os
+import sqlite3
+import threading
+import time
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED_MISSING_PATH = 'skipped-missing-path'
+SKIPPED_MULTICHANNEL = 'skipped-multichannel'
+SKIPPED_TAGS = 'skipped-tags'
+SKIPPED_24BIT = 'skipped-24bit'
+
+# Torrents with these statuses aren't looked at again on later runs,
+# except that failed ones are retried once they've been left for
+# retry_failed_after seconds (or straight away with --retry-failed).
+# Skipped releases are, since the data may turn up, the tags may be
+# fixed or the 24-bit behaviour may change.
+default_skip = frozenset([DONE, FAILED])
+retry_failed_after = 7 * 24 * 60 * 60
+
+# Skipped releases, which are looked at again on every run, even once
+# the snatched list is only paged through as far as new snatches.
+recheck = frozenset([SKIPPED_MISSING_PATH, SKIPPED_MULTICHANNEL, SKIPPED_TAGS, SKIPPED_24BIT])
+
+class StateStore(object):
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS torrents (
+                torrentid INTEGER PRIMARY KEY,
+                groupid INTEGER,
+                status TEXT NOT NULL,
+                message TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL)''')
+            # Progress through the snatched list; see
+            # RedactedAPI.snatched().
+            self._db.execute('''CREATE TABLE IF NOT EXISTS sync (
+                key TEXT PRIMARY KEY,
+                high_water INTEGER,
+                cursor INTEGER,
+                sweep_top INTEGER)''')
+
+    def record(self, torrentid, groupid, status, message=None):
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                self._db.execute('''INSERT OR IGNORE INTO torrents (torrentid, groupid, status, message, created, updated)
+                    VALUES (?, ?, ?, ?, ?, ?)''', (int(torrentid), groupid, status, message, now, now))
+                self._db.execute('UPDATE torrents SET groupid = ?, status = ?, message = ?, updated = ? WHERE torrentid = ?',
+                                 (groupid, status, message, now, int(torrentid)))
+
+    def status(self, torrentid):
+        '''
+        Returns (status, message, updated) for a torrent, or None if it
+        hasn't been seen.
+        '''
+        with self._lock:
+            return self._db.execute('SELECT status, message, updated FROM torrents WHERE torrentid = ?',
+                                    (int(torrentid),)).fetchone()
+
+    def skip_set(self, statuses=default_skip):
+        '''
+        Returns a set-like object containing the torrents which have one
+        of the given statuses, for use as RedactedAPI.snatched()'s skip
+        argument.
+        '''
+        return SkipSet(self, frozenset(statuses))
+
+    def torrents(self, statuses, updated_before=None):
+        '''
+        Returns (groupid, torrentid) for every torrent with one of the
+        given statuses, least recently updated first. If updated_before
+        is given, only torrents last recorded before then are returned.
+        '''
+        statuses = list(statuses)
+        if updated_before is None:
+            updated_before = float('inf')
+        with self._lock:
+            return self._db.execute('''SELECT groupid, torrentid FROM torrents
+                WHERE groupid IS NOT NULL AND status IN (%s) AND updated < ?
+                ORDER BY updated''' % ', '.join('?' * len(statuses)), statuses + [updated_before]).fetchall()
+
+    def counts(self):
+        '''
+        Returns a dict of the number of torrents with each status.
+        '''
+        with self._lock:
+            return dict(self._db.execute('SELECT status, COUNT(*) FROM torrents GROUP BY status'))
+
+    def get_sync(self, key):
+        '''
+        Returns (high_water, cursor, sweep_top) for a snatched list, all
+        None if it has never been synced.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT high_water, cursor, sweep_top FROM sync WHERE key = ?', (key,)).fetchone()
+        return row or (None, None, None)
+
+    def set_sync(self, key, high_water, cursor, sweep_top):
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO sync (key, high_water, cursor, sweep_top) VALUES (?, ?, ?, ?)',
+                                 (key, high_water, cursor, sweep_top))
+
+    def import_pickle(self, path):
+        '''
+        Imports the set of torrent ids pickled by older versions as done,
+        unless they've already been recorded. Returns the number of
+        torrents imported.
+        '''
+        seen = pickle.load(open(path, 'rb'))
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                before = self._db.total_changes
+                self._db.executemany('''INSERT OR IGNORE INTO torrents (torrentid, groupid, status, message, created, updated)
+                    VALUES (?, NULL, ?, ?, ?, ?)''', [(int(torrentid), DONE, 'imported', now, now) for torrentid in seen])
+                return self._db.total_changes - before
+
+    def close(self):
+        self._db.close()
+
+class SkipSet(object):
+    def __init__(self, store, statuses):
+        self.store = store
+        self.statuses = statuses
+
+    def __contains__(self, torrentid):
+        row = self.store.status(torrentid)
+        return row is not None and row[0] in self.statuses
@@ -74,14 +74,16 @@ def scrub_tag(name, value):
 
     return scrubbed_value
 
-def check_tags(filename, check_tracknumber_format=True):
+def check_tags(filename, check_tracknumber_format=True, info=None):
     """Verify that the file has the required redacted.ch tags.
 
     Returns (True, None) if OK, (False, msg) if a tag is missing or
-    invalid.
+    invalid. If the file has already been loaded with mutagen, it can
+    be passed as info to save loading it again.
 
     """
-    info = mutagen.File(filename, easy=True)
+    if info is None:
+        info = mutagen.File(filename, easy=True)
     for tag in ['artist', 'album', 'title', 'tracknumber']:
         if tag not in info.keys():
             return (False, '"%s" has no %s tag' % (filename, tag))
@@ -3,11 +3,60 @@
 import sys
 import os
 import ConfigParser
-import json
+import Queue
 import argparse
-
-from redactedapi import RedactedAPI
-
+import threading
+import time
+
+from redactedapi import RedactedAPI, default_site_url
+import crawlqueue
+import ratelimit
+import responsecache
+
+
+def rank(torrents, rejected):
+    '''
+    Orders better.php rows by how likely they are to have enough
+    snatches. Rows never checked come first, oldest (lowest id) first,
+    since they've had longest to be snatched; then rows turned down
+    before, the most snatched first.
+    '''
+    def key(torrent):
+        if torrent['id'] in rejected:
+            return (1, -rejected[torrent['id']][0])
+        return (0, torrent['id'])
+    return sorted(torrents, key=key)
+
+class Downloader(threading.Thread):
+    '''
+    Fetches the .torrent files of accepted torrents in the background,
+    so candidates can be tested while earlier ones download.
+    '''
+    def __init__(self, api, queue, torrent_dir):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.api = api
+        self.queue = queue
+        self.torrent_dir = torrent_dir
+        self.jobs = Queue.Queue()
+
+    def run(self):
+        while True:
+            torrent = self.jobs.get()
+            try:
+                if torrent is None:
+                    return
+                data = self.api.get_torrent(torrent['id'])
+                if data is None:
+                    raise Exception('no torrent file returned')
+                with open(os.path.join(self.torrent_dir, '%i.torrent' % torrent['id']), 'wb') as f:
+                    f.write(data)
+                self.queue.set_state(torrent['id'], crawlqueue.DOWNLOADING)
+            except Exception as e:
+                print "Couldn't fetch #%i, dropping it: %s" % (torrent['id'], e)
+                self.queue.remove(torrent['id'])
+            finally:
+                self.jobs.task_done()
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, prog='redactedbetter')
@@ -16,9 +65,15 @@ def main():
     parser.add_argument('-b', '--better', type=int, help='better transcode search type',
                         default=3)
     parser.add_argument('-c', '--count', type=int, help='backlog max size', default=5)
+    parser.add_argument('-r', '--recheck-after', type=float, help='hours before testing a torrent which didn\'t have enough snatches again',
+                        default=24)
+    parser.add_argument('-i', '--interval', type=int, help='seconds to wait before refreshing better.php when it has no new candidates',
+                        default=600)
     parser.add_argument('--config', help='the location of the configuration file',
                         default=os.path.expanduser('~/.redactedbetter/config'))
-    parser.add_argument('--cache', help='the location of the cache',
+    parser.add_argument('--queue', help='the location of the crawl queue',
+                        default=crawlqueue.default_path)
+    parser.add_argument('--cache', help='the location of the cache used by older versions, which is imported into the queue',
                         default=os.path.expanduser('~/.redactedbetter/cache-crawl'))
 
     args = parser.parse_args()
@@ -34,39 +89,77 @@ def main():
     username = config.get('redacted', 'username')
     password = config.get('redacted', 'password')
     torrent_dir = os.path.expanduser(config.get('redacted', 'torrent_dir'))
-
-    print 'Logging in to RED...'
-    api = RedactedAPI(username, password)
-
     try:
-        cache = json.load(open(args.cache))
-    except:
-        cache = []
-        json.dump(cache, open(args.cache, 'wb'))
-
-    while len(cache) < args.count:
-        print 'Refreshing better.php and finding %i candidates' % (args.count - len(cache))
-        for torrent in api.get_better(args.better):
-            if len(cache) >= args.count:
-                break
-
-            print "Testing #%i" % torrent['id']
-            info = api.get_torrent_info(torrent['id'])
-            if info['snatched'] < args.snatches:
-                continue
-
-            print "Fetching #%i with %i snatches" % (torrent['id'], info['snatched'])
-
-            with open(os.path.join(torrent_dir, '%i.torrent' % torrent['id']), 'wb') as f:
-                f.write(api.get_torrent(torrent['id']))
+        site_url = config.get('redacted', 'site_url') or default_site_url
+    except ConfigParser.NoOptionError:
+        site_url = default_site_url
+    try:
+        rate_limit_file = os.path.expanduser(config.get('redacted', 'rate_limit_file'))
+    except ConfigParser.NoOptionError:
+        rate_limit_file = os.path.expanduser('~/.redactedbetter/ratelimit')
+    try:
+        response_cache = os.path.expanduser(config.get('redacted', 'response_cache'))
+    except ConfigParser.NoOptionError:
+        response_cache = os.path.expanduser('~/.redactedbetter/responses.db')
+    try:
+        session_file = os.path.expanduser(config.get('redacted', 'session_file'))
+    except ConfigParser.NoOptionError:
+        session_file = os.path.expanduser('~/.redactedbetter/session')
 
-            torrent['hash'] = info['infoHash'].upper()
-            torrent['done'] = False
+    if rate_limit_file:
+        limiter = ratelimit.FileRateLimiter(rate_limit_file)
+    else:
+        limiter = ratelimit.RateLimiter()
 
-            cache = json.load(open(args.cache))
-            cache.append(torrent)
-            json.dump(cache, open(args.cache, 'wb'))
+    if response_cache:
+        cache = responsecache.ResponseCache(response_cache)
+    else:
+        cache = None
 
+    print 'Logging in to RED...'
+    api = RedactedAPI(username, password, limiter=limiter, cache=cache, site_url=site_url, session_file=session_file)
+
+    queue = crawlqueue.open_queue(args.queue, args.cache)
+
+    downloader = Downloader(api, queue, torrent_dir)
+    downloader.start()
+    max_age = args.recheck_after * 60 * 60
+
+    while queue.count() < args.count:
+        while queue.count() < args.count:
+            print 'Refreshing better.php and finding %i candidates' % (args.count - queue.count())
+            torrents = [torrent for torrent in api.get_better(args.better) if torrent['id'] not in queue]
+            rejected = queue.rejected([torrent['id'] for torrent in torrents])
+            now = time.time()
+            candidates = [torrent for torrent in torrents
+                          if torrent['id'] not in rejected or now - rejected[torrent['id']][1] > max_age]
+            if len(candidates) < len(torrents):
+                print 'Skipping %i torrents without enough snatches at their last check' % (len(torrents) - len(candidates))
+
+            for torrent in rank(candidates, rejected):
+                if queue.count() >= args.count:
+                    break
+
+                print "Testing #%i" % torrent['id']
+                info = api.get_torrent_info(torrent['id'])
+                if info['snatched'] < args.snatches:
+                    queue.reject(torrent['id'], info['snatched'])
+                    continue
+
+                print "Fetching #%i with %i snatches" % (torrent['id'], info['snatched'])
+                if queue.add(torrent, info['infoHash']):
+                    downloader.jobs.put(torrent)
+
+            if not candidates and queue.count() < args.count:
+                print 'No new candidates, waiting %i seconds' % args.interval
+                time.sleep(args.interval)
+
+        # Failed downloads are dropped from the queue, in which case
+        # there's more to find.
+        downloader.jobs.join()
+
+    downloader.jobs.put(None)
+    downloader.join()
     print 'Nothing left to do'
 
 if __name__ == '__main__':
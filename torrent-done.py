@@ -1,18 +1,38 @@
 #!/usr/bin/env python2.7
 
+import os
+import socket
 from sys import argv, exit
-import json
+
+import crawlqueue
+import jobsocket
 
 
 def main():
-    torrent_hash = argv[5].upper()
+    # The torrent client's arguments, and optionally --socket PATH for a
+    # daemon which isn't on the default socket.
+    args = argv[1:]
+    socket_path = jobsocket.default_path
+    if '--socket' in args:
+        i = args.index('--socket')
+        socket_path = args[i + 1]
+        del args[i:i + 2]
+    torrent_hash = args[4].upper()
 
-    # find the hash and set done = true
-    cache = json.load(open('~/.redactedbetter/cache-crawl'))
-    for torrent in cache:
-        if torrent['hash'] == torrent_hash:
-            torrent['done'] = True
-            json.dump(cache, open('~/.redactedbetter/cache-crawl', 'wb'))
-            exit(0)
+    # find the hash and mark it done
+    queue = crawlqueue.CrawlQueue()
+    if queue.set_state_by_hash(torrent_hash, crawlqueue.DONE):
+        # Hand it straight to a running daemon, if there is one;
+        # otherwise torrent-parse.py picks it up.
+        if os.path.exists(socket_path):
+            try:
+                jobsocket.submit(hashes=[torrent_hash], path=socket_path)
+                queue.set_state_by_hash(torrent_hash, crawlqueue.TRANSCODED)
+            except (socket.error, jobsocket.JobSocketError):
+                pass
+        exit(0)
 
     exit(1)
+
+if __name__ == '__main__':
+    main()
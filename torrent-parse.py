@@ -2,51 +2,66 @@
 # make me a conjob!
 
 import os
-import json
 import argparse
-import ConfigParser
+import errno
+import fcntl
+import socket
 import sys
 
+import crawlqueue
+import jobsocket
+
 lockfile = os.path.expanduser('~/.redactedbetter/parse.lock')
 
 
 def main():
-    if os.path.exists(lockfile):
-        print "Found lockfile, exiting...."
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, prog='redactedbetter')
-    parser.add_argument('--cache', help='the location of the cache',
+    parser.add_argument('--queue', help='the location of the crawl queue',
+                        default=crawlqueue.default_path)
+    parser.add_argument('--cache', help='the location of the cache used by older versions, which is imported into the queue',
                         default=os.path.expanduser('~/.redactedbetter/cache-crawl'))
+    parser.add_argument('--socket', help='the socket of a running redactedbetter --daemon, which is given the jobs if it\'s there',
+                        default=jobsocket.default_path)
 
     args = parser.parse_args()
-    while parse_stuff(args.cache) and not os.path.exists(lockfile):
+
+    # Hold an exclusive lock for as long as we run, so only one parser
+    # transcodes at a time. The lock goes away with the process, so a
+    # crashed run can't leave it behind.
+    lock = open(lockfile, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            print "Found lockfile, exiting...."
+            sys.exit(0)
+        raise
+
+    queue = crawlqueue.open_queue(args.queue, args.cache)
+    while parse_stuff(queue, args.socket):
         print "Done encoding cycle"
 
 
-def parse_stuff(cache_file):
-    open(lockfile, 'w').close()
-    try:
-        cache = json.load(open(cache_file))
-    except:
-        cache = []
-        json.dump(cache, open(cache_file, 'wb'))
-
-    permalinks = []
-    cache_new = []
-    for torrent in cache:
-        if torrent['done']:
-            permalinks.append('"https://redacted.ch/%s"' % torrent['permalink'])
-        else:
-            cache_new.append(torrent)
-
-    if len(permalinks) == 0:
+def parse_stuff(queue, socket_path=jobsocket.default_path):
+    done = queue.in_state(crawlqueue.DONE)
+    if len(done) == 0:
         return False
 
-    cmdline = "python2 redactedbetter %s" % ' '.join(permalinks)
-    json.dump(cache_new, open(cache_file, 'wb'))
+    urls = ['https://redacted.ch/%s' % torrent['permalink'] for torrent in done]
+    # Like the old cache, don't retry these if the run fails;
+    # redactedbetter keeps its own record of failures.
+    for torrent in done:
+        queue.set_state(torrent['id'], crawlqueue.TRANSCODED)
+
+    if os.path.exists(socket_path):
+        try:
+            print "Queued %d releases on the daemon" % jobsocket.submit(urls, path=socket_path)
+            return True
+        except (socket.error, jobsocket.JobSocketError) as e:
+            print "Can't reach the daemon, running redactedbetter instead: %s" % e
+    cmdline = "python2 redactedbetter %s" % ' '.join('"%s"' % url for url in urls)
     print "Executing... " + cmdline
     os.system(cmdline)
-    os.remove(lockfile)
     return True
 
 
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+'''
+Builds .torrent files for redactedbetter without running mktorrent.
+
+The metainfo matches what `mktorrent -s RED -p` produces for a
+directory: the same file order, info dictionary and piece hashes, so
+the info hash is identical for the same piece length. Pieces are hashed
+on several threads straight out of memory-mapped files (hashlib
+releases the GIL while it works).
+
+A StreamingHasher can instead hash a transcode's files as the encoders
+finish them, while they're still in the page cache, so the torrent is
+ready without reading the transcode back from disk.
+'''
+import hashlib
+import math
+import mmap
+import os
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from _version import __version__
+
+# Piece lengths are powers of two, given as the exponent like
+# mktorrent's -l option.
+MIN_PIECE_LENGTH = 15
+MAX_PIECE_LENGTH = 24
+# Aim for at most this many pieces when choosing a piece length.
+TARGET_PIECES = 2000
+
+class TorrentException(Exception):
+    pass
+
+def bencode(obj):
+    if isinstance(obj, bool):
+        obj = int(obj)
+    if isinstance(obj, (int, long)):
+        return 'i%de' % obj
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    if isinstance(obj, str):
+        return '%d:%s' % (len(obj), obj)
+    if isinstance(obj, (list, tuple)):
+        return 'l%se' % ''.join(bencode(item) for item in obj)
+    if isinstance(obj, dict):
+        items = sorted((key.encode('utf-8') if isinstance(key, unicode) else key, value) for key, value in obj.items())
+        return 'd%se' % ''.join(bencode(key) + bencode(value) for key, value in items)
+    raise TypeError('Can\'t bencode %r' % (obj,))
+
+def bdecode(data):
+    def decode(i):
+        c = data[i]
+        if c == 'i':
+            end = data.index('e', i)
+            return int(data[i + 1:end]), end + 1
+        if c == 'l':
+            i += 1
+            items = []
+            while data[i] != 'e':
+                item, i = decode(i)
+                items.append(item)
+            return items, i + 1
+        if c == 'd':
+            i += 1
+            items = {}
+            while data[i] != 'e':
+                key, i = decode(i)
+                items[key], i = decode(i)
+            return items, i + 1
+        colon = data.index(':', i)
+        end = colon + 1 + int(data[i:colon])
+        return data[colon + 1:end], end
+    obj, end = decode(0)
+    if end != len(data):
+        raise TorrentException('Trailing data after bencoded object')
+    return obj
+
+def choose_piece_length(total_size):
+    '''
+    Returns the smallest piece length exponent which keeps the number
+    of pieces at or below TARGET_PIECES, within the supported range.
+    '''
+    if total_size <= 0:
+        return MIN_PIECE_LENGTH
+    exponent = int(math.ceil(math.log(float(total_size) / TARGET_PIECES, 2)))
+    return max(MIN_PIECE_LENGTH, min(MAX_PIECE_LENGTH, exponent))
+
+def file_list(input_dir):
+    '''
+    Returns (relative path, size) for every file in input_dir, in the
+    order mktorrent puts them: sorted bytewise by path.
+    '''
+    files = []
+    for path, dirs, filenames in os.walk(input_dir):
+        for filename in filenames:
+            full_path = os.path.join(path, filename)
+            files.append((os.path.relpath(full_path, input_dir), os.path.getsize(full_path)))
+    return sorted(files)
+
+class PieceHasher(object):
+    '''
+    Hashes the pieces of a list of files, as if they were concatenated,
+    on a pool of threads.
+    '''
+    def __init__(self, paths, piece_length, threads=None):
+        self.paths = paths
+        self.piece_length = piece_length
+        self.threads = threads or cpu_count()
+        self.sizes = [os.path.getsize(path) for path in paths]
+        self.total_size = sum(self.sizes)
+
+    def _segments(self):
+        '''
+        Returns, for each piece, the list of (file index, offset,
+        length) segments it's made of.
+        '''
+        pieces = []
+        current = []
+        remaining = self.piece_length
+        for index, size in enumerate(self.sizes):
+            offset = 0
+            while offset < size:
+                length = min(remaining, size - offset)
+                current.append((index, offset, length))
+                offset += length
+                remaining -= length
+                if remaining == 0:
+                    pieces.append(current)
+                    current = []
+                    remaining = self.piece_length
+        if current:
+            pieces.append(current)
+        return pieces
+
+    def digest(self):
+        '''
+        Returns the concatenated SHA-1 digests of every piece.
+        '''
+        maps = []
+        try:
+            for path, size in zip(self.paths, self.sizes):
+                if size == 0:
+                    # mmap can't map empty files; they have no segments.
+                    maps.append(None)
+                    continue
+                with open(path, 'rb') as f:
+                    maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+            def hash_piece(segments):
+                sha1 = hashlib.sha1()
+                for index, offset, length in segments:
+                    sha1.update(buffer(maps[index], offset, length))
+                return sha1.digest()
+
+            segments = self._segments()
+            if self.threads > 1 and len(segments) > 1:
+                pool = ThreadPool(self.threads)
+                try:
+                    digests = pool.map(hash_piece, segments, chunksize=max(1, len(segments) // (self.threads * 4)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                digests = map(hash_piece, segments)
+            return ''.join(digests)
+        finally:
+            for m in maps:
+                if m is not None:
+                    m.close()
+
+class StreamingHasher(object):
+    '''
+    Hashes the pieces of a torrent while its files are being written.
+
+    It's given every path the torrent will contain up front, and then
+    told about each file as soon as it's complete, in any order. Files
+    are hashed in torrent order, each as soon as every file before it
+    has been, so at most one read of each file is needed.
+    '''
+    def __init__(self, input_dir, paths, piece_length, bufsize=1 << 20):
+        self.input_dir = os.path.abspath(input_dir)
+        self.piece_length = piece_length
+        self.bufsize = bufsize
+        self.order = sorted(os.path.relpath(os.path.abspath(path), self.input_dir) for path in paths)
+        self.expected = set(self.order)
+        self.ready = set()
+        # Files added which weren't expected; the hashes are no good
+        # if there are any.
+        self.unexpected = []
+        # (relative path, size) of each file hashed so far.
+        self.files = []
+        self.pieces = []
+        self._piece = hashlib.sha1()
+        self._filled = 0
+
+    def add(self, path):
+        '''
+        Marks a file complete, and hashes any files which are now ready.
+        '''
+        relpath = os.path.relpath(os.path.abspath(path), self.input_dir)
+        if relpath not in self.expected:
+            self.unexpected.append(relpath)
+            return
+        self.ready.add(relpath)
+        while len(self.files) < len(self.order) and self.order[len(self.files)] in self.ready:
+            self._hash_file(self.order[len(self.files)])
+
+    def _hash_file(self, relpath):
+        size = 0
+        with open(os.path.join(self.input_dir, relpath), 'rb') as f:
+            while True:
+                data = f.read(min(self.bufsize, self.piece_length - self._filled))
+                if not data:
+                    break
+                self._piece.update(data)
+                self._filled += len(data)
+                size += len(data)
+                if self._filled == self.piece_length:
+                    self.pieces.append(self._piece.digest())
+                    self._piece = hashlib.sha1()
+                    self._filled = 0
+        self.files.append((relpath, size))
+
+    def complete(self):
+        return len(self.files) == len(self.order)
+
+    def info(self, name, source='RED'):
+        '''
+        Returns the info dictionary, or None if the files hashed aren't
+        exactly what's in input_dir now: if some were never added, if
+        others turned up, or if any changed size after being hashed.
+        '''
+        if not self.files or not self.complete() or self.unexpected:
+            return None
+        if file_list(self.input_dir) != self.files:
+            return None
+        pieces = list(self.pieces)
+        if self._filled:
+            pieces.append(self._piece.copy().digest())
+        return info_dict(name, self.files, self.piece_length, ''.join(pieces), source)
+
+def info_dict(name, files, piece_length, pieces, source='RED'):
+    '''
+    Returns the info dictionary for a multi-file torrent, laid out the
+    way mktorrent -p -s does.
+    '''
+    return {
+        'files': [{'length': size, 'path': relpath.split(os.sep)} for relpath, size in files],
+        'name': name,
+        'piece length': piece_length,
+        'pieces': pieces,
+        'private': 1,
+        'source': source,
+    }
+
+def write_torrent(torrent, tracker_url, info, created_by=None):
+    metainfo = {
+        'announce': tracker_url,
+        'created by': created_by or 'redactedbetter %s' % __version__,
+        'creation date': int(time.time()),
+        'info': info,
+    }
+    with open(torrent, 'wb') as f:
+        f.write(bencode(metainfo))
+    return torrent
+
+def make_torrent(input_dir, output_dir, tracker, passkey, piece_length=None, threads=None, source='RED', hasher=None):
+    '''
+    Creates a private torrent for input_dir in output_dir, like
+    transcode.make_torrent() but in-process. piece_length is an
+    exponent (e.g., 18 for 256KiB); if it's None or 'auto', one is
+    chosen from the size of the files.
+
+    If hasher is a StreamingHasher which has already hashed input_dir,
+    its pieces (and piece length) are used instead of reading the
+    files again.
+    '''
+    input_dir = os.path.abspath(input_dir)
+    torrent = os.path.join(output_dir, os.path.basename(input_dir)) + ".torrent"
+    if not os.path.exists(os.path.dirname(torrent)):
+        os.makedirs(os.path.dirname(torrent))
+    tracker_url = '%(tracker)s%(passkey)s/announce' % {
+        'tracker' : tracker,
+        'passkey' : passkey,
+    }
+
+    if hasher is not None:
+        info = hasher.info(os.path.basename(input_dir), source)
+        if info is not None:
+            return write_torrent(torrent, tracker_url, info)
+
+    files = file_list(input_dir)
+    if not files:
+        raise TorrentException('No files to add to torrent in "%s"' % input_dir)
+    total_size = sum(size for relpath, size in files)
+    if piece_length in (None, '', 'auto'):
+        piece_length = choose_piece_length(total_size)
+    piece_length = 1 << int(piece_length)
+
+    hasher = PieceHasher([os.path.join(input_dir, relpath) for relpath, size in files], piece_length, threads)
+    info = info_dict(os.path.basename(input_dir), files, piece_length, hasher.digest(), source)
+    return write_torrent(torrent, tracker_url, info)
+
+def info_hash(torrent):
+    '''
+    Returns the hex info hash of a .torrent file.
+    '''
+    metainfo = bdecode(open(torrent, 'rb').read())
+    return hashlib.sha1(bencode(metainfo['info'])).hexdigest()
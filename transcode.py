@@ -9,9 +9,17 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import deque
 
 import mutagen.flac
 
+import encodecache
+import linking
+import metrics
+import releaseprobe
 import tagging
 
 encoders = {
@@ -21,6 +29,25 @@ encoders = {
     'FLAC': {'enc': 'flac', 'ext': '.flac', 'opts': '--best'}
 }
 
+# Rough output bitrates in kbps, for guessing the size of a transcode
+# before it has been done.
+estimated_bitrates = {
+    '320': 320,
+    'V0': 256,
+    'V2': 192,
+    'FLAC': 900,
+}
+
+# ionice options for each --ionice class. best-effort is given its
+# lowest priority.
+ionice_classes = {
+    'best-effort': ['-c', '2', '-n', '7'],
+    'idle': ['-c', '3'],
+}
+
+# Non-audio files which are copied into transcodes.
+allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
+
 class TranscodeException(Exception):
     pass
 
@@ -70,6 +97,66 @@ def run_pipeline(cmds):
     results.append((last_proc.returncode, last_stderr))
     return results
 
+# Like run_pipeline(), but for a single decoder feeding several
+# encoders at once: the decoder's output is copied to the standard
+# input of every encoder. An encoder that exits early is dropped
+# without affecting the others; the decoder only sees SIGPIPE if
+# every encoder has gone.
+#
+# Returns a list of (code, stderr) pairs, the decoder's first and then
+# one per encoder.
+def run_fanout(decoder, encoder_commands, bufsize=1 << 16):
+    # stderr goes to temporary files rather than pipes, since we're
+    # only reading from the decoder and a chatty process could
+    # otherwise fill its stderr pipe and stall.
+    stderrs = [tempfile.TemporaryFile() for _ in range(len(encoder_commands) + 1)]
+    devnull = open(os.devnull, 'wb')
+    # See run_pipeline() about SIGPIPE.
+    sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    procs = []
+    try:
+        procs.append(subprocess.Popen(shlex.split(decoder), stdout=subprocess.PIPE, stderr=stderrs[0]))
+        for cmd, stderr in zip(encoder_commands, stderrs[1:]):
+            procs.append(subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stdout=devnull, stderr=stderr))
+    except:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        signal.signal(signal.SIGPIPE, sigpipe_handler)
+        devnull.close()
+
+    source = procs[0].stdout
+    sinks = [proc.stdin for proc in procs[1:]]
+    open_sinks = list(sinks)
+    while open_sinks:
+        data = source.read(bufsize)
+        if not data:
+            break
+        for sink in list(open_sinks):
+            try:
+                sink.write(data)
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                open_sinks.remove(sink)
+    for sink in sinks:
+        try:
+            sink.close()
+        except IOError:
+            pass
+    # Ensure the decoder receives SIGPIPE if every encoder exited first
+    source.close()
+
+    results = []
+    for proc, stderr in zip(procs, stderrs):
+        proc.wait()
+        stderr.seek(0)
+        results.append((proc.returncode, stderr.read()))
+        stderr.close()
+    return results
+
 def locate(root, match_function, ignore_dotfiles=True):
     '''
     Yields all filenames within the root directory for which match_function returns True.
@@ -87,20 +174,21 @@ def ext_matcher(*extensions):
     '''
     return lambda f: os.path.splitext(f)[-1].lower() in extensions
 
+# These each probe the release from scratch; when asking more than one
+# question about a release, use a releaseprobe.ReleaseProbe instead.
+
 def is_24bit(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is 24 bit.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.bits_per_sample > 16 for flac in flacs)
+    return releaseprobe.ReleaseProbe(flac_dir).is_24bit()
 
 def is_multichannel(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is multichannel.
     '''
     try:
-        flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-        return any(flac.info.channels > 2 for flac in flacs)
+        return releaseprobe.ReleaseProbe(flac_dir).is_multichannel()
     except:
         return False
 
@@ -115,14 +203,7 @@ def resample_rate(flac_dir):
     '''
     Returns the rate to which the release should be resampled.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    original_rate = max(flac.info.sample_rate for flac in flacs)
-    if original_rate % 44100 == 0:
-        return 44100
-    elif original_rate % 48000 == 0:
-        return 48000
-    else:
-        return None
+    return releaseprobe.ReleaseProbe(flac_dir).resample_rate()
 
 def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
     '''
@@ -159,18 +240,66 @@ def transcode_commands(output_format, resample, needed_sample_rate, flac_file, t
         commands = map(lambda cmd: cmd % transcode_args, transcoding_steps)
     return commands
 
+def multi_transcode_commands(output_formats, resample, needed_sample_rate, flac_file, transcode_files):
+    '''
+    Return a (decoder, [encoders]) pair of commands for transcoding
+    flac_file into several output_formats at once: the decoder's
+    output is fed to every encoder, one per entry in transcode_files.
+    '''
+    if resample:
+        flac_decoder = 'sox %(FLAC)s -G -b 16 -t wav - rate -v -L %(SAMPLERATE)s dither'
+    else:
+        flac_decoder = 'flac -dcs -- %(FLAC)s'
+
+    lame_encoder = 'lame -S %(OPTS)s - %(FILE)s'
+    flac_encoder = 'flac %(OPTS)s -o %(FILE)s -'
+
+    decoder = flac_decoder % {
+        'FLAC' : pipes.quote(flac_file),
+        'SAMPLERATE' : needed_sample_rate,
+    }
+
+    encoder_commands = []
+    for output_format, transcode_file in zip(output_formats, transcode_files):
+        if encoders[output_format]['enc'] == 'lame':
+            encoder = lame_encoder
+        elif encoders[output_format]['enc'] == 'flac':
+            encoder = flac_encoder
+        encoder_commands.append(encoder % {
+            'FILE' : pipes.quote(transcode_file),
+            'OPTS' : encoders[output_format]['opts'],
+        })
+    return decoder, encoder_commands
+
 # Pool.map() can't pickle lambdas, so we need a helper function.
-def pool_transcode((flac_file, output_dir, output_format)):
-    return transcode(flac_file, output_dir, output_format)
+# Pool jobs return their result along with the metrics they recorded,
+# which TranscodePool merges into the parent's registry.
+def pool_transcode((flac_file, output_dir, output_format, info)):
+    return transcode(flac_file, output_dir, output_format, info, worker_cache), metrics.registry.drain()
+
+def pool_transcode_multi((flac_file, outputs, info)):
+    return transcode_multi(flac_file, outputs, info, worker_cache), metrics.registry.drain()
+
+# Pool.apply_async() has no error callback in Python 2, so jobs which
+# are gated by a Controller return their exception instead of raising
+# it.
+def pool_guarded((function, args)):
+    try:
+        return None, function(args)
+    except Exception as e:
+        return e, None
 
-def transcode(flac_file, output_dir, output_format):
+def transcode_settings(flac_file, info=None):
     '''
-    Transcodes a FLAC file into another format.
+    Returns (resample, needed_sample_rate) for transcoding flac_file,
+    or raises an exception if it can't be transcoded. If info (the
+    file's stream info) is not given, it is read from the file.
     '''
     # gather metadata from the flac file
-    flac_info = mutagen.flac.FLAC(flac_file)
-    sample_rate = flac_info.info.sample_rate
-    bits_per_sample = flac_info.info.bits_per_sample
+    if info is None:
+        info = mutagen.flac.FLAC(flac_file).info
+    sample_rate = info.sample_rate
+    bits_per_sample = info.bits_per_sample
     resample = sample_rate > 48000 or bits_per_sample > 16
 
     # if resampling isn't needed then needed_sample_rate will not be used.
@@ -184,14 +313,26 @@ def transcode(flac_file, output_dir, output_format):
         else:
             raise UnknownSampleRateException('FLAC file "{0}" has a sample rate {1}, which is not 88.2 , 176.4 or 96kHz but needs resampling, this is unsupported'.format(flac_file, sample_rate))
 
-    if flac_info.info.channels > 2:
+    if info.channels > 2:
         raise TranscodeDownmixException('FLAC file "%s" has more than 2 channels, unsupported' % flac_file)
 
-    # determine the new filename
+    return resample, needed_sample_rate
+
+def transcode_path(flac_file, output_dir, output_format):
+    '''
+    Returns the name of the file flac_file is transcoded to.
+    '''
     transcode_basename = os.path.splitext(os.path.basename(flac_file))[0]
     transcode_basename = re.sub(r'[\?<>\\*\|"]', '_', transcode_basename)
     transcode_file = os.path.join(output_dir, transcode_basename)
-    transcode_file += encoders[output_format]['ext']
+    return transcode_file + encoders[output_format]['ext']
+
+def transcode_filename(flac_file, output_dir, output_format):
+    '''
+    Returns the name of the file flac_file is transcoded to, creating
+    its directory if necessary.
+    '''
+    transcode_file = transcode_path(flac_file, output_dir, output_format)
 
     if not os.path.exists(os.path.dirname(transcode_file)):
         try:
@@ -203,10 +344,13 @@ def transcode(flac_file, output_dir, output_format):
                 pass
             else:
                 raise e
+    return transcode_file
 
-    commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
-    results = run_pipeline(commands)
-
+def check_pipeline(flac_file, commands, results):
+    '''
+    Raises TranscodeException if any process in a transcode pipeline
+    failed.
+    '''
     # Check for problems. Because it's a pipeline, the earliest one is
     # usually the source. The exception is -SIGPIPE, which is caused
     # by "backpressure" due to a later command failing: ignore those
@@ -222,13 +366,179 @@ def transcode(flac_file, output_dir, output_format):
         # XXX: this should probably never happen....
         raise TranscodeException('Transcode of file "%s" failed: SIGPIPE' % flac_file)
 
-    tagging.copy_tags(flac_file, transcode_file)
-    (ok, msg) = tagging.check_tags(transcode_file)
+def finish_transcode(flac_file, transcode_file, output_format=None):
+    with metrics.timer('tag_seconds', format=output_format):
+        tagging.copy_tags(flac_file, transcode_file)
+        (ok, msg) = tagging.check_tags(transcode_file)
     if not ok:
         raise TranscodeException('Tag check failed on transcoded file: %s' % msg)
 
+# The first line of each program's --version; see program_version().
+program_versions = {}
+
+def program_version(program):
+    '''
+    Returns the first line of `program --version`, or '' if it can't be
+    run, so encodes made by different versions can be told apart.
+    '''
+    if program not in program_versions:
+        try:
+            with open(os.devnull, 'rb') as devnull:
+                output = subprocess.Popen([program, '--version'], stdin=devnull, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT).communicate()[0]
+        except OSError:
+            output = ''
+        lines = output.strip().splitlines()
+        program_versions[program] = lines[0].strip() if lines else ''
+    return program_versions[program]
+
+def cache_commands(output_format, resample, needed_sample_rate, decode_once=False):
+    '''
+    Returns the commands transcode() runs for a file, or with
+    decode_once, transcode_multi() does, without any file names.
+    '''
+    if decode_once:
+        decoder, encoder_commands = multi_transcode_commands([output_format], resample, needed_sample_rate, '', [''])
+        return [decoder] + encoder_commands
+    return transcode_commands(output_format, resample, needed_sample_rate, '', '')
+
+def encode_cache_key(info, commands):
+    '''
+    Returns the encodecache key for the output of commands (see
+    cache_commands()) from a file with stream info info, or None if it
+    can't be cached: the FLAC has no MD5 signature, so its audio can't
+    be told apart from any other.
+    '''
+    if info is None or not info.md5_signature:
+        return None
+    versions = [program_version(shlex.split(command)[0]) for command in commands]
+    return encodecache.make_key('%032x' % info.md5_signature, info.sample_rate, info.bits_per_sample, info.channels,
+                                *(commands + versions))
+
+def cache_transcode(cache, info, commands, transcode_file):
+    '''
+    Adds a fresh, untagged transcode, made by commands, to cache if
+    there is one.
+    '''
+    if cache is None:
+        return
+    key = encode_cache_key(info, commands)
+    if key is not None:
+        cache.store(key, transcode_file)
+
+def cached_transcode(cache, flac_file, output_dir, output_format, info):
+    '''
+    Puts flac_file's transcode into output_dir from cache, and tags it.
+    Returns the transcoded file, or None if it isn't cached.
+    '''
+    try:
+        resample, needed_sample_rate = transcode_settings(flac_file, info)
+    except TranscodeException:
+        # Left for the transcode to report.
+        return None
+    # An encode made either way will do; they only differ when a FLAC
+    # is resampled to FLAC.
+    keys = []
+    for decode_once in (False, True):
+        key = encode_cache_key(info, cache_commands(output_format, resample, needed_sample_rate, decode_once))
+        if key is not None and key not in keys:
+            keys.append(key)
+    if not keys:
+        return None
+    transcode_file = transcode_filename(flac_file, output_dir, output_format)
+    if not cache.fetch(keys, transcode_file):
+        metrics.inc('encode_cache_total', format=output_format, result='miss')
+        return None
+    metrics.inc('encode_cache_total', format=output_format, result='hit')
+    finish_transcode(flac_file, transcode_file, output_format)
+    return transcode_file
+
+def record_transcode(info, output_format, elapsed):
+    metrics.observe('transcode_file_seconds', elapsed, format=output_format)
+    if info is not None and elapsed > 0:
+        metrics.observe('encode_realtime_factor', info.length / elapsed, format=output_format)
+
+def transcode(flac_file, output_dir, output_format, info=None, cache=None):
+    '''
+    Transcodes a FLAC file into another format, adding the encode to
+    cache (an encodecache.EncodeCache) if one is given.
+    '''
+    resample, needed_sample_rate = transcode_settings(flac_file, info)
+    transcode_file = transcode_filename(flac_file, output_dir, output_format)
+
+    commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
+    start = time.time()
+    results = run_pipeline(commands)
+    record_transcode(info, output_format, time.time() - start)
+    check_pipeline(flac_file, commands, results)
+
+    cache_transcode(cache, info, cache_commands(output_format, resample, needed_sample_rate), transcode_file)
+    finish_transcode(flac_file, transcode_file, output_format)
     return transcode_file
 
+def transcode_multi(flac_file, outputs, info=None, cache=None):
+    '''
+    Transcodes a FLAC file into several formats, decoding (and
+    resampling) it only once. outputs is a list of (output_dir,
+    output_format) pairs.
+
+    Returns a dict mapping each output format to None if it succeeded
+    or an error message if it failed, so one broken encoder doesn't
+    fail the others. Encodes are added to cache as in transcode().
+    '''
+    resample, needed_sample_rate = transcode_settings(flac_file, info)
+    output_formats = [output_format for (output_dir, output_format) in outputs]
+    transcode_files = [transcode_filename(flac_file, output_dir, output_format) for (output_dir, output_format) in outputs]
+
+    decoder, encoder_commands = multi_transcode_commands(output_formats, resample, needed_sample_rate, flac_file, transcode_files)
+    start = time.time()
+    results = run_fanout(decoder, encoder_commands)
+    # The encoders all ran at once, so each took about as long.
+    elapsed = time.time() - start
+    for output_format in output_formats:
+        record_transcode(info, output_format, elapsed)
+
+    errors = {}
+    for (output_format, transcode_file, encoder, result) in zip(output_formats, transcode_files, encoder_commands, results[1:]):
+        try:
+            # Each encoder, with the decoder in front of it, is
+            # checked just like a two-process pipeline.
+            check_pipeline(flac_file, [decoder, encoder], [results[0], result])
+            cache_transcode(cache, info, cache_commands(output_format, resample, needed_sample_rate, True),
+                            transcode_file)
+            finish_transcode(flac_file, transcode_file, output_format)
+            errors[output_format] = None
+        except (TranscodeException, tagging.TaggingException) as e:
+            errors[output_format] = str(e)
+    return errors
+
+def estimated_size(probe, output_format):
+    '''
+    Returns a rough guess at the size in bytes of the audio in a
+    release once it's transcoded to output_format.
+    '''
+    seconds = sum(info.length for info in probe.info.values())
+    return int(seconds * estimated_bitrates[output_format] * 1000 / 8)
+
+def job_cost(info):
+    '''
+    Returns a rough estimate of the cost of transcoding a file, from its
+    stream info: its length, scaled by its sample rate relative to a
+    CD's, since decoding and resampling work per sample.
+    '''
+    return info.length * info.sample_rate / 44100.0
+
+def dispatch_order(probe, longest_first=True):
+    '''
+    Returns the FLAC files of a release in the order they should be
+    queued. Queueing the most expensive files first keeps one long
+    track from starting last and leaving every other worker idle while
+    it finishes.
+    '''
+    if not longest_first:
+        return list(probe.flac_files)
+    return sorted(probe.flac_files, key=lambda filename: job_cost(probe.info[filename]), reverse=True)
+
 def get_transcode_dir(flac_dir, output_dir, output_format, resample):
     transcode_dir = os.path.basename(flac_dir)
 
@@ -249,16 +559,325 @@ def get_transcode_dir(flac_dir, output_dir, output_format, resample):
 
     return os.path.join(output_dir, transcode_dir)
 
-def transcode_release(flac_dir, output_dir, output_format, max_threads=None):
+# To ensure that a terminated pool subprocess terminates its
+# children, we make each pool subprocess a process group leader,
+# and handle SIGTERM by killing the process group. This will
+# ensure there are no lingering processes when a transcode fails
+# or is interrupted.
+#
+# The decoders and encoders inherit the worker's niceness and I/O
+# class, so they're set here.
+#
+# The parent's encode cache connection can't be used after the fork,
+# so each worker opens its own.
+worker_cache = None
+
+def pool_initializer(niceness=None, ioclass=None, cache=None):
+    global worker_cache
+    os.setsid()
+    if niceness:
+        os.nice(niceness)
+    if ioclass is not None:
+        try:
+            subprocess.call(['ionice'] + ionice_classes[ioclass] + ['-p', str(os.getpid())])
+        except OSError:
+            # No ionice; redactedbetter has already warned about it.
+            pass
+    # Don't send anything the parent recorded before the fork back to
+    # it.
+    metrics.registry.reset()
+    if cache is not None:
+        worker_cache = encodecache.EncodeCache(cache.directory, cache.max_size)
+    def sigterm_handler(signum, frame):
+        # We're about to SIGTERM the group, including us; ignore
+        # it so we can finish this handler.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        pgid = os.getpgid(0)
+        os.killpg(pgid, signal.SIGTERM)
+        sys.exit(-signal.SIGTERM)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+class TranscodePool(object):
     '''
-    Transcode a FLAC release into another format.
+    A pool of transcode processes which can be shared by any number of
+    releases and formats, so it only has to be started once per run
+    and the next release's files can start while the last one's
+    stragglers finish.
+
+    If a concurrency.Controller is given, the pool has its maximum
+    number of processes, but only as many files as its limit are
+    handed to them at once; the rest wait in the pool's own queue.
+    niceness and ioclass (one of ionice_classes) are applied to the
+    processes.
+
+    If an encodecache.EncodeCache is given, encodes are added to it, and
+    files found in it are put in place by submit_cached() rather than
+    queued.
+    '''
+    def __init__(self, processes=None, controller=None, niceness=None, ioclass=None, cache=None):
+        if controller is not None:
+            processes = controller.maximum
+        self.pool = multiprocessing.Pool(processes, initializer=pool_initializer, initargs=(niceness, ioclass, cache))
+        self.controller = controller
+        self.cache = cache
+        if controller is not None:
+            self._cond = threading.Condition()
+            self._queue = deque()
+            self._running = set()
+            self._closing = False
+            self._dispatcher = threading.Thread(target=self._dispatch)
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+
+    def submit(self, flac_file, output_dir, output_format, info=None):
+        '''
+        Queues a single file, returning a multiprocessing AsyncResult (or
+        a Job, which works the same, if the pool has a controller).
+        '''
+        return self._apply(pool_transcode, (flac_file, output_dir, output_format, info), output_format, info)
+
+    def submit_multi(self, flac_file, outputs, info=None):
+        '''
+        Queues a single file to be transcoded into several formats at
+        once (see transcode_multi()).
+        '''
+        key = '+'.join(sorted(output_format for (output_dir, output_format) in outputs))
+        return self._apply(pool_transcode_multi, (flac_file, outputs, info), key, info)
+
+    def submit_cached(self, flac_file, output_dir, output_format, info=None):
+        '''
+        Puts a single file's transcode in place from the encode cache.
+        Returns a finished Job, with a result like submit_multi()'s, or
+        None if it isn't cached and has to be submitted.
+        '''
+        if self.cache is None:
+            return None
+        job = Job(None, None, output_format, None)
+        try:
+            if cached_transcode(self.cache, flac_file, output_dir, output_format, info) is None:
+                return None
+            job.set(None, ({output_format: None}, None))
+        except Exception as e:
+            job.set(e, None)
+        return job
+
+    def _apply(self, function, args, key, info):
+        if self.controller is None:
+            return self.pool.apply_async(function, [args], callback=self._merge)
+        if info is not None and (info.sample_rate > 48000 or info.bits_per_sample > 16):
+            # Much slower than the same format without resampling.
+            key += ' resampled'
+        job = Job(function, args, key, None if info is None else job_cost(info))
+        with self._cond:
+            self._queue.append(job)
+            self._cond.notify()
+        return job
+
+    def _merge(self, (value, samples)):
+        metrics.registry.merge(samples)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closing and not self._queue:
+                        return
+                    if self._queue and len(self._running) < self.controller.adjust():
+                        break
+                    self._cond.wait(self.controller.interval)
+                job = self._queue.popleft()
+                self._running.add(job)
+            job.started = time.time()
+            self.pool.apply_async(pool_guarded, [(job.function, job.args)], callback=lambda result, job=job: self._finish(job, result))
+
+    def _finish(self, job, (error, result)):
+        if error is None:
+            self._merge(result)
+            if job.cost is not None:
+                self.controller.record(job.key, job.cost, time.time() - job.started)
+        with self._cond:
+            self._running.discard(job)
+            self._cond.notify()
+        job.set(error, result)
+
+    def close(self):
+        if self.controller is not None:
+            with self._cond:
+                self._closing = True
+                self._cond.notify()
+            # Join with a timeout, so a KeyboardInterrupt gets through.
+            while self._dispatcher.is_alive():
+                self._dispatcher.join(1)
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        if self.controller is not None:
+            with self._cond:
+                self._closing = True
+                jobs = list(self._queue) + list(self._running)
+                self._queue.clear()
+                self._cond.notify()
+            for job in jobs:
+                job.set(TranscodeException('Transcode pool terminated'), None)
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+class Job(object):
+    '''
+    A file queued on a TranscodePool with a controller. get(), wait()
+    and ready() work like a multiprocessing AsyncResult's.
+    '''
+    def __init__(self, function, args, key, cost):
+        self.function = function
+        self.args = args
+        # The format(s), and estimated cost, for the controller.
+        self.key = key
+        self.cost = cost
+        self.started = None
+        self._event = threading.Event()
+        self._error = None
+        self._value = None
+
+    def set(self, error, value):
+        if self._event.is_set():
+            return
+        self._error = error
+        self._value = value
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class PendingTranscode(object):
+    '''
+    A release transcode which has been queued on a TranscodePool.
+    get() waits for it to finish and returns the transcode directory.
+    '''
+    def __init__(self, flac_dir, transcode_dir, results=None, pool=None, output_format=None, extra_files=(), outputs=(),
+                 linker=None):
+        self.flac_dir = flac_dir
+        self.transcode_dir = transcode_dir
+        # Non-audio files to put alongside the transcodes, with linker.
+        self.extra_files = extra_files
+        self.linker = linker or linking.default_linker
+        # None if no encode is necessary.
+        self.results = results
+        # The file each result writes, in the same order.
+        self.outputs = outputs
+        # If set, a torrentfile.StreamingHasher which is given each
+        # output file as soon as it's complete.
+        self.hasher = None
+        # If set, the pool belongs to this transcode alone and can be
+        # terminated as soon as a file fails.
+        self.pool = pool
+        # If set, the results come from transcode_multi(), and only
+        # the errors for this format concern us.
+        self.output_format = output_format
+
+    def files(self):
+        '''
+        Returns every file the transcode directory will contain once
+        the transcode is done.
+        '''
+        extras = [os.path.join(os.path.dirname(filename).replace(self.flac_dir, self.transcode_dir), os.path.basename(filename))
+                  for filename in self.extra_files]
+        return list(self.outputs) + extras
+
+    def get(self, timeout=60 * 60 * 12):
+        if self.results is None:
+            return self.transcode_dir
+
+        try:
+            # XXX: get() the results with a large timeout, as a
+            # workaround for a KeyboardInterrupt in Pool.join(). c.f.,
+            # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
+            for result, output in map(None, self.results, self.outputs):
+                value, samples = result.get(timeout)
+                if self.output_format is not None and value[self.output_format]:
+                    raise TranscodeException(value[self.output_format])
+                if self.hasher is not None:
+                    self.hasher.add(output)
+
+            # link or copy other files
+            for filename in self.extra_files:
+                new_dir = os.path.dirname(filename).replace(self.flac_dir, self.transcode_dir)
+                if not os.path.exists(new_dir):
+                    os.makedirs(new_dir)
+                new_file = self.linker.link(filename, new_dir)
+                if self.hasher is not None:
+                    self.hasher.add(new_file)
+
+            return self.transcode_dir
+
+        except:
+            if self.pool is not None:
+                self.pool.terminate()
+            else:
+                # The pool is shared, so we can't kill our remaining
+                # files; wait for them so they don't write into
+                # transcode_dir after it's gone.
+                for result in self.results:
+                    result.wait()
+            # Cleanup.
+            #
+            # ASSERT: transcode_dir was created by this function and does
+            # not contain anything other than the transcoded files!
+            shutil.rmtree(self.transcode_dir)
+            raise
+
+    def abandon(self):
+        '''
+        Gives up on a transcode which won't be waited on with get(),
+        waiting for its files to finish and removing the transcode
+        directory.
+        '''
+        if self.results is None:
+            return
+        if self.pool is not None:
+            self.pool.terminate()
+        else:
+            for result in self.results:
+                result.wait()
+        if os.path.exists(self.transcode_dir):
+            shutil.rmtree(self.transcode_dir)
+
+def start_transcode_release(flac_dir, output_dir, output_format, pool, probe=None, linker=None, longest_first=True):
+    '''
+    Queue the transcode of a FLAC release into another format on a
+    TranscodePool, returning a PendingTranscode. If the release has
+    already been probed, pass its ReleaseProbe as probe. Non-audio
+    files are put in the transcode with linker, a linking.Linker.
+    Files are queued longest first unless longest_first is False (see
+    dispatch_order()).
     '''
     flac_dir = os.path.abspath(flac_dir)
     output_dir = os.path.abspath(output_dir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    if probe is None:
+        probe = releaseprobe.ReleaseProbe(flac_dir)
 
     # check if we need to resample
-    resample = needs_resampling(flac_dir)
+    resample = probe.needs_resampling()
 
     # check if we need to encode
     if output_format == 'FLAC' and not resample:
@@ -266,11 +885,11 @@ def transcode_release(flac_dir, output_dir, output_format, max_threads=None):
         # do what the user expects.
         if output_dir != os.path.dirname(flac_dir):
             print "Warning: no encode necessary, so files won't be placed in", output_dir
-        return flac_dir
+        return PendingTranscode(flac_dir, flac_dir)
 
     # make a new directory for the transcoded files
     #
-    # NB: The cleanup code that follows this block assumes that
+    # NB: The cleanup code in PendingTranscode assumes that
     # transcode_dir is a new directory created exclusively for this
     # transcode. Do not change this assumption without considering the
     # consequences!
@@ -280,72 +899,104 @@ def transcode_release(flac_dir, output_dir, output_format, max_threads=None):
     else:
         raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
 
-    # To ensure that a terminated pool subprocess terminates its
-    # children, we make each pool subprocess a process group leader,
-    # and handle SIGTERM by killing the process group. This will
-    # ensure there are no lingering processes when a transcode fails
-    # or is interrupted.
-    def pool_initializer():
-        os.setsid()
-        def sigterm_handler(signum, frame):
-            # We're about to SIGTERM the group, including us; ignore
-            # it so we can finish this handler.
-            signal.signal(signal.SIGTERM, signal.SIG_IGN)
-            pgid = os.getpgid(0)
-            os.killpg(pgid, signal.SIGTERM)
-            sys.exit(-signal.SIGTERM)
-        signal.signal(signal.SIGTERM, sigterm_handler)
+    results = []
+    outputs = []
+    for filename in dispatch_order(probe, longest_first):
+        file_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
+        result = pool.submit_cached(filename, file_dir, output_format, probe.info[filename])
+        if result is None:
+            result = pool.submit(filename, file_dir, output_format, probe.info[filename])
+        results.append(result)
+        outputs.append(transcode_path(filename, file_dir, output_format))
+    return PendingTranscode(flac_dir, transcode_dir, results, extra_files=probe.files(*allowed_extensions), outputs=outputs,
+                            linker=linker)
+
+def start_transcode_release_multi(flac_dir, output_dir, output_formats, pool, probe=None, linker=None, longest_first=True):
+    '''
+    Queue the transcode of a FLAC release into several formats on a
+    TranscodePool, decoding each file only once. Returns a dict mapping
+    each output format to its PendingTranscode.
+    '''
+    flac_dir = os.path.abspath(flac_dir)
+    output_dir = os.path.abspath(output_dir)
+    if probe is None:
+        probe = releaseprobe.ReleaseProbe(flac_dir)
+    resample = probe.needs_resampling()
+
+    pending = {}
+    transcode_dirs = {}
+    for output_format in output_formats:
+        if output_format == 'FLAC' and not resample:
+            pending[output_format] = start_transcode_release(flac_dir, output_dir, output_format, pool, probe, linker,
+                                                             longest_first)
+        else:
+            transcode_dirs[output_format] = get_transcode_dir(flac_dir, output_dir, output_format, resample)
 
-    try:
-        # create transcoding threads
-        #
-        # Use Pool.map() rather than Pool.apply_async() as it will raise
-        # exceptions synchronously. (Don't want to waste any more time
-        # when a transcode breaks.)
-        #
-        # XXX: actually, use Pool.map_async() and then get() the result
-        # with a large timeout, as a workaround for a KeyboardInterrupt in
-        # Pool.join(). c.f.,
-        # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
-        pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
-        try:
-            result = pool.map_async(pool_transcode, [(filename, os.path.dirname(filename).replace(flac_dir, transcode_dir), output_format) for filename in flac_files])
-            result.get(60 * 60 * 12)
-            pool.close()
-        except:
-            pool.terminate()
-            raise
-        finally:
-            pool.join()
-
-        # copy other files
-        allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
-        allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
-        for filename in allowed_files:
-            new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
-            if not os.path.exists(new_dir):
-                os.makedirs(new_dir)
-            shutil.copy(filename, new_dir)
+    for transcode_dir in transcode_dirs.values():
+        if os.path.exists(transcode_dir):
+            raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+    # NB: see start_transcode_release() about transcode_dir.
+    for transcode_dir in transcode_dirs.values():
+        os.makedirs(transcode_dir)
 
-        return transcode_dir
+    # Each format's results, one per file: the file's transcode_multi()
+    # job, or for a format found in the encode cache, its own.
+    format_results = dict((output_format, []) for output_format in transcode_dirs)
+    format_outputs = dict((output_format, []) for output_format in transcode_dirs)
+    for filename in dispatch_order(probe, longest_first):
+        outputs = []
+        for output_format, transcode_dir in transcode_dirs.items():
+            file_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
+            format_outputs[output_format].append(transcode_path(filename, file_dir, output_format))
+            result = pool.submit_cached(filename, file_dir, output_format, probe.info[filename])
+            if result is None:
+                outputs.append((file_dir, output_format))
+            else:
+                format_results[output_format].append(result)
+        if outputs:
+            result = pool.submit_multi(filename, outputs, probe.info[filename])
+            for file_dir, output_format in outputs:
+                format_results[output_format].append(result)
+    extra_files = probe.files(*allowed_extensions)
+    for output_format, transcode_dir in transcode_dirs.items():
+        pending[output_format] = PendingTranscode(flac_dir, transcode_dir, format_results[output_format],
+                                                  output_format=output_format,
+                                                  extra_files=extra_files, outputs=format_outputs[output_format],
+                                                  linker=linker)
+    return pending
+
+def transcode_release(flac_dir, output_dir, output_format, max_threads=None, pool=None, probe=None, linker=None):
+    '''
+    Transcode a FLAC release into another format.
 
+    If pool is given, the files are transcoded on that TranscodePool;
+    otherwise a pool of max_threads processes is created for the
+    duration of the transcode.
+    '''
+    if pool is not None:
+        return start_transcode_release(flac_dir, output_dir, output_format, pool, probe, linker).get()
+
+    pool = TranscodePool(max_threads)
+    try:
+        pending = start_transcode_release(flac_dir, output_dir, output_format, pool, probe, linker)
+        # Don't waste any more time when a transcode breaks.
+        pending.pool = pool
+        transcode_dir = pending.get()
+        pool.close()
+        return transcode_dir
     except:
-        # Cleanup.
-        #
-        # ASSERT: transcode_dir was created by this function and does
-        # not contain anything other than the transcoded files!
-        shutil.rmtree(transcode_dir)
+        pool.terminate()
         raise
 
 def make_torrent(input_dir, output_dir, tracker, passkey, piece_length):
     torrent = os.path.join(output_dir, os.path.basename(input_dir)) + ".torrent"
     if not os.path.exists(os.path.dirname(torrent)):
-        os.path.makedirs(os.path.dirname(torrent))
+        os.makedirs(os.path.dirname(torrent))
     tracker_url = '%(tracker)s%(passkey)s/announce' % {
         'tracker' : tracker,
         'passkey' : passkey,
     }
-    command = ["mktorrent", "-s", "RED", "-p", "-a", tracker_url, "-o", torrent, "-l", piece_length, input_dir]
+    command = ["mktorrent", "-s", "RED", "-p", "-a", tracker_url, "-o", torrent, "-l", str(piece_length), input_dir]
     subprocess.check_output(command, stderr=subprocess.STDOUT)
     return torrent
 